@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Times the hot paths of emlx against a synthetic store and writes the
+results as JSON, so runs on different revisions can be compared.
+
+    python benchmarks/run.py --messages 2000 --output results.json
+
+The store is generated into a temporary directory unless --store points at
+one made earlier by synthetic.py.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from emlx.mailbox import AMMailbox  # noqa: E402
+from emlx.message import EmlxMessage  # noqa: E402
+from synthetic import generate_store  # noqa: E402
+
+
+def timed(func, repeat):
+    """
+    Calls :arg:func :arg:repeat times and returns the timings along with the
+    result of the last call.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def summarize(times, items=None, nbytes=None):
+    result = {
+        "runs": len(times),
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+    }
+    if items is not None:
+        result["items"] = items
+        result["items_per_second"] = items / result["min"] if result["min"] else None
+    if nbytes is not None:
+        result["bytes"] = nbytes
+        result["bytes_per_second"] = nbytes / result["min"] if result["min"] else None
+    return result
+
+
+def bench_scan(boxes, repeat):
+    def scan():
+        # A fresh mailbox each time so nothing is memoized between runs.
+        return sum(len(AMMailbox(path).messages()) for path in boxes)
+
+    times, count = timed(scan, repeat)
+    return summarize(times, items=count)
+
+
+def bench_parse(refs, repeat):
+    paths = [ref.msg_path for ref in refs if not ref.partial]
+
+    def parse():
+        size = 0
+        for path in paths:
+            msg = EmlxMessage.from_path(path)
+            msg.flags
+            msg.date_received
+            size += msg.content_size
+        return size
+
+    times, size = timed(parse, repeat)
+    return summarize(times, items=len(paths), nbytes=size)
+
+
+def bench_read(refs, repeat):
+    paths = [ref.msg_path for ref in refs if not ref.partial]
+
+    def read():
+        size = 0
+        for path in paths:
+            with EmlxMessage.open(path) as msg:
+                msg.maildir_flags
+                size += msg.content_size
+        return size
+
+    times, size = timed(read, repeat)
+    return summarize(times, items=len(paths), nbytes=size)
+
+
+def bench_partial(refs, repeat):
+    partial = [ref for ref in refs if ref.partial]
+
+    def reassemble():
+        return sum(len(ref.get_message().content) for ref in partial)
+
+    times, size = timed(reassemble, repeat)
+    return summarize(times, items=len(partial), nbytes=size)
+
+
+def bench_convert(boxes, repeat, jobs, workdir):
+    maildir = os.path.join(workdir, "Maildir")
+    command = [sys.executable, "-m", "emlx.script", "-q", "-r", "--fsync", "none",
+               "-j", str(jobs), "-m", maildir] + boxes
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(HERE)] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    def convert():
+        shutil.rmtree(maildir, ignore_errors=True)
+        subprocess.run(command, check=True, env=env, stdout=subprocess.DEVNULL)
+        return sum(len(files) for _, _, files in os.walk(maildir))
+
+    times, count = timed(convert, repeat)
+    shutil.rmtree(maildir, ignore_errors=True)
+    return summarize(times, items=count)
+
+
+BENCHMARKS = ("scan", "parse", "read", "partial", "convert")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmarks emlx against a synthetic Apple Mail store",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument("--store", default=None, help="use this store instead of generating one")
+    parser.add_argument("--mailboxes", default=4, type=int, help="number of mailboxes to generate")
+    parser.add_argument("--messages", default=1000, type=int, help="messages per generated mailbox")
+    parser.add_argument("--body-size", default=4096, type=int, help="approximate size of complete message bodies")
+    parser.add_argument("--partial-ratio", default=0.1, type=float, help="share of messages generated as partial")
+    parser.add_argument("--parts", default=2, type=int, help=".emlxpart files per partial message")
+    parser.add_argument("--part-size", default=16384, type=int, help="decoded size of each .emlxpart")
+    parser.add_argument("--seed", default=0, type=int, help="random seed for the generated store")
+    parser.add_argument("--repeat", default=3, type=int, help="runs of each benchmark")
+    parser.add_argument("--jobs", default=1, type=int, help="worker processes for the convert benchmark")
+    parser.add_argument("--only", action="append", choices=BENCHMARKS, help="run only these benchmarks")
+    parser.add_argument("--output", default="-", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="emlx-bench-")
+    try:
+        if args.store:
+            store = {"path": args.store}
+        else:
+            store = generate_store(workdir, args.mailboxes, args.messages, args.body_size,
+                                   args.partial_ratio, args.parts, args.part_size, args.seed)
+        boxes = sorted(glob.glob(os.path.join(store["path"], "*.mbox")))
+        refs = [ref for path in boxes for ref in AMMailbox(path).messages()]
+
+        selected = args.only or BENCHMARKS
+        results = {}
+        for name in BENCHMARKS:
+            if name not in selected:
+                continue
+            if name == "scan":
+                results[name] = bench_scan(boxes, args.repeat)
+            elif name == "parse":
+                results[name] = bench_parse(refs, args.repeat)
+            elif name == "read":
+                results[name] = bench_read(refs, args.repeat)
+            elif name == "partial":
+                results[name] = bench_partial(refs, args.repeat)
+            elif name == "convert":
+                results[name] = bench_convert(boxes, args.repeat, args.jobs, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "store": store,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Generates synthetic Apple Mail V3 stores for benchmarking.
+
+Each mailbox gets a GUID directory with a Data trie laid out the way Mail
+lays it out, holding complete .emlx files and, for a share of the
+messages, .partial.emlx files with their .emlxpart attachments.
+"""
+
+import argparse
+import base64
+import json
+import os
+import plistlib
+import random
+import uuid
+
+
+def trie_dir(data_dir, msgid):
+    excess = list(str(msgid))[:-3]
+    excess.reverse()
+    return os.path.join(data_dir, *excess)
+
+
+def emlx_bytes(body, flags, date):
+    meta = plistlib.dumps({
+        "date-received": date,
+        "date-sent": date - 60,
+        "flags": flags,
+        "subject": "synthetic",
+    })
+    return str(len(body)).encode("ascii").ljust(10) + b"\n" + body + meta
+
+
+def text_body(rng, msgid, size):
+    headers = (
+        "From: Sender %d <sender%d@example.com>\n"
+        "To: recipient@example.com\n"
+        "Subject: Message %d\n"
+        "Message-ID: <%d@example.com>\n"
+        "Date: Mon, 1 Jan 2018 00:00:00 +0000\n"
+        "MIME-Version: 1.0\n"
+        "Content-Type: text/plain; charset=us-ascii\n\n" % (msgid % 97, msgid % 97, msgid, msgid)
+    ).encode("ascii")
+    line = b"The quick brown fox jumps over the lazy dog %d.\n" % rng.randrange(1000)
+    return headers + line * max(1, size // len(line))
+
+
+def partial_body(msgid, parts):
+    # The text part is present; the attachments are stubs left for .emlxpart files.
+    lines = [
+        "From: Sender <sender@example.com>",
+        "To: recipient@example.com",
+        "Subject: Partial %d" % msgid,
+        "Message-ID: <partial-%d@example.com>" % msgid,
+        "MIME-Version: 1.0",
+        'Content-Type: multipart/mixed; boundary="BOUNDARY-%d"' % msgid,
+        "",
+        "--BOUNDARY-%d" % msgid,
+        "Content-Type: text/plain",
+        "",
+        "See the attachments.",
+    ]
+    for partno in range(2, parts + 2):
+        lines.extend([
+            "--BOUNDARY-%d" % msgid,
+            "Content-Type: application/octet-stream",
+            "Content-Transfer-Encoding: base64",
+            'Content-Disposition: attachment; filename="part%d.bin"' % partno,
+            "X-Apple-Content-Length: 0",
+            "",
+        ])
+    lines.append("--BOUNDARY-%d--" % msgid)
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def generate_store(root, mailboxes=4, messages=1000, body_size=4096, partial_ratio=0.1,
+                   parts=2, part_size=16384, seed=0):
+    """
+    Writes a store below :arg:root and returns a summary of what was made.
+    The store is laid out as ``root/V3/Mailboxes/Box<n>.mbox``.
+    """
+    rng = random.Random(seed)
+    mailboxes_dir = os.path.join(root, "V3", "Mailboxes")
+    summary = {
+        "path": mailboxes_dir,
+        "mailboxes": mailboxes,
+        "messages": 0,
+        "partial": 0,
+        "parts": 0,
+        "bytes": 0,
+    }
+
+    part_data = base64.encodebytes(bytes(rng.getrandbits(8) for _ in range(part_size)))
+    for boxno in range(mailboxes):
+        box = os.path.join(mailboxes_dir, "Box%d.mbox" % boxno)
+        guid = str(uuid.UUID(int=rng.getrandbits(128))).upper()
+        data_dir = os.path.join(box, guid, "Data")
+        os.makedirs(data_dir, exist_ok=True)
+        with open(os.path.join(box, "Info.plist"), "wb") as f:
+            plistlib.dump({}, f)
+
+        for msgid in range(1, messages + 1):
+            messages_dir = os.path.join(trie_dir(data_dir, msgid), "Messages")
+            os.makedirs(messages_dir, exist_ok=True)
+            flags = rng.getrandbits(10)
+            date = 1500000000 + msgid * 60
+
+            if rng.random() < partial_ratio:
+                data = emlx_bytes(partial_body(msgid, parts), flags, date)
+                name = "%d.partial.emlx" % msgid
+                for partno in range(2, parts + 2):
+                    with open(os.path.join(messages_dir, "%d.%d.emlxpart" % (msgid, partno)), "wb") as f:
+                        f.write(part_data)
+                    summary["parts"] += 1
+                    summary["bytes"] += len(part_data)
+                summary["partial"] += 1
+            else:
+                data = emlx_bytes(text_body(rng, msgid, body_size), flags, date)
+                name = "%d.emlx" % msgid
+
+            with open(os.path.join(messages_dir, name), "wb") as f:
+                f.write(data)
+            summary["messages"] += 1
+            summary["bytes"] += len(data)
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="generates a synthetic Apple Mail store",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument("--mailboxes", default=4, type=int, help="number of mailboxes")
+    parser.add_argument("--messages", default=1000, type=int, help="messages per mailbox")
+    parser.add_argument("--body-size", default=4096, type=int, help="approximate size of complete message bodies")
+    parser.add_argument("--partial-ratio", default=0.1, type=float, help="share of messages stored as partial")
+    parser.add_argument("--parts", default=2, type=int, help=".emlxpart files per partial message")
+    parser.add_argument("--part-size", default=16384, type=int, help="decoded size of each .emlxpart")
+    parser.add_argument("--seed", default=0, type=int, help="random seed")
+    parser.add_argument("root", help="directory to create the store in")
+    args = parser.parse_args()
+
+    summary = generate_store(args.root, args.mailboxes, args.messages, args.body_size,
+                             args.partial_ratio, args.parts, args.part_size, args.seed)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import functools
+import threading
+
+from emlx.converter import MessageImporter, open_seen, release_stale_claims
+from emlx.stats import recording
+
+# Refs or messages allowed to queue up between stages before the producer
+# has to wait.
+QUEUE_SIZE = 256
+
+# Messages being read or written at once.
+CONCURRENCY = 8
+
+_DONE = object()
+
+
+async def aiter_messages(mailbox, queue_size=QUEUE_SIZE, **filters):
+    """
+    Yields the messages of :arg:mailbox without blocking the event loop. The
+    scan runs on a thread and hands refs over through a bounded queue, so it
+    stays at most :arg:queue_size refs ahead of the consumer. Keyword
+    arguments are passed on to :meth:`AMMailbox.iter_messages`.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(queue_size)
+    stop = threading.Event()
+
+    def produce():
+        for ref in mailbox.iter_messages(**filters):
+            if stop.is_set():
+                return
+            asyncio.run_coroutine_threadsafe(queue.put(ref), loop).result()
+        if not stop.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(_DONE), loop).result()
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            get = asyncio.ensure_future(queue.get())
+            # Don't wait forever on a producer that has died.
+            await asyncio.wait([get, producer], return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                producer.result()
+                return
+            ref = get.result()
+            if ref is _DONE:
+                break
+            yield ref
+    finally:
+        stop.set()
+        # Unblock a producer waiting on a full queue so it can see the stop.
+        while not queue.empty():
+            queue.get_nowait()
+        await producer
+
+
+async def import_messages(refs, maildir_path, folder=None, concurrency=CONCURRENCY,
+                          queue_size=QUEUE_SIZE, executor=None, stats=None, **options):
+    """
+    Imports the refs from the async iterable :arg:refs into :arg:folder of
+    the maildir at :arg:maildir_path (its root when None).
+
+    Refs go through a queue of :arg:queue_size to :arg:concurrency workers,
+    so a slow maildir holds the producer back rather than letting refs pile
+    up. Each worker reads and writes its messages on :arg:executor (the
+    loop's default when None) with a batched writer of its own, and with
+    dedup they share one :class:`SeenSet`. If :arg:stats is a
+    :class:`Stats`, the stages run on the executor are recorded into it.
+    Other keyword arguments are passed on to :class:`MessageImporter`.
+
+    Returns the number of refs processed and a list of ``(ref, error)``
+    pairs for those that failed.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(queue_size)
+    failed = []
+    count = 0
+
+    def call(func, *args):
+        with recording(stats):
+            return func(*args)
+
+    def run(func, *args):
+        return loop.run_in_executor(executor, functools.partial(call, func, *args))
+
+    async def worker(importer):
+        nonlocal count
+        writer = await run(importer.writer, folder)
+        try:
+            while True:
+                ref = await queue.get()
+                if ref is _DONE:
+                    break
+                try:
+                    await run(importer.import_item, ref, writer)
+                except Exception as e:
+                    failed.append((ref, repr(e)))
+                count += 1
+            if writer is not None:
+                await run(importer.flush, writer)
+        finally:
+            # A worker that fails or is cancelled leaves its unflushed
+            # messages in tmp/, so their claims must not stand.
+            importer.release_claims()
+
+    workers = max(1, concurrency)
+
+    async def feed():
+        async for ref in refs:
+            await queue.put(ref)
+        for _ in range(workers):
+            await queue.put(_DONE)
+
+    await run(functools.partial(release_stale_claims, maildir_path, **options))
+    seen = None
+    if options.get("dedup") is not None and not options.get("dry_run"):
+        seen = await run(open_seen, maildir_path, options.get("dedup_path"))
+    importers = []
+    try:
+        for _ in range(workers):
+            importers.append(await run(functools.partial(MessageImporter, maildir_path, seen=seen, **options)))
+        # Set up the destination once before the workers race to it.
+        await run(importers[0].writer, folder)
+
+        # If a worker fails the rest, and the feeder blocked on the queue they
+        # no longer drain, are cancelled rather than left waiting.
+        tasks = [asyncio.ensure_future(feed())]
+        tasks.extend(asyncio.ensure_future(worker(importer)) for importer in importers)
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+    finally:
+        for importer in importers:
+            importer.close()
+        if seen is not None:
+            seen.close()
+
+    return count, failed
+
+
+async def import_mailbox(mailbox, maildir_path, folder=None, **options):
+    """
+    Imports every message in :arg:mailbox into the maildir at
+    :arg:maildir_path. Takes the same options as :func:`import_messages`
+    and returns the same result.
+    """
+    queue_size = options.get("queue_size", QUEUE_SIZE)
+    return await import_messages(aiter_messages(mailbox, queue_size=queue_size), maildir_path, folder, **options)
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+# Listings younger than this may still change within the same mtime tick,
+# so they are not trusted on the next run.
+RACY_INTERVAL = 2.0
+
+
+class DirectoryCache(object):
+    """
+    A persistent cache of directory listings keyed by directory mtime.
+
+    Adding or removing an entry updates the mtime of its directory, so a
+    listing can be reused for as long as the mtime it was taken at still
+    matches. A rescan of an unchanged mail store then costs one ``stat``
+    per directory instead of reading every ``Messages`` directory.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS listings ("
+            " path TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " entries TEXT NOT NULL)"
+        )
+
+    def __repr__(self):
+        return "<DirectoryCache path=%s>" % self.path
+
+    def listdir(self, path):
+        """
+        Returns a list of ``(name, is_dir)`` pairs for the entries in
+        :arg:path, from the cache if the directory has not changed.
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mtime_ns, entries FROM listings WHERE path = ?", (path,)
+            ).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            return [
+                (name[:-1], True) if name[-1:] == "/" else (name, False)
+                for name in row[1].split("\n") if name
+            ]
+
+        entries = [(dirent.name, dirent.is_dir()) for dirent in os.scandir(path)]
+        if time.time() - mtime_ns / 1e9 > RACY_INTERVAL:
+            encoded = "\n".join(name + "/" if is_dir else name for name, is_dir in entries)
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO listings (path, mtime_ns, entries) VALUES (?, ?, ?)",
+                    (path, mtime_ns, encoded)
+                )
+        return entries
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
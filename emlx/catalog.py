@@ -0,0 +1,212 @@
+import email.policy
+import email.utils
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from emlx.mailbox import AMMessageRef
+from emlx.message import EmlxMessage
+
+# Messages read at once while indexing; reading headers is mostly waiting
+# on the disk.
+INDEX_JOBS = 8
+
+# Rows inserted per statement batch.
+INSERT_BATCH = 1000
+
+COLUMNS = (
+    "mailbox", "msgid", "partial", "path", "size", "mtime_ns",
+    "date_sent", "date_received", "flags",
+    "subject", "sender", "sender_name", "recipients", "message_id", "in_reply_to",
+)
+
+
+def _header(headers, name):
+    # Headers that fail to decode are kept as they are.
+    try:
+        value = headers.get(name)
+    except Exception:
+        value = next((v for k, v in headers.raw_items() if k.lower() == name.lower()), None)
+    if value is None:
+        return None
+    return " ".join(str(value).split()) or None
+
+
+def _entry(ref, headers, date_sent=None, date_received=None, flags=None, plist_get=None, size=None, mtime_ns=None):
+    subject = _header(headers, "Subject")
+    sender = _header(headers, "From")
+    # Mail keeps some of the same fields in the plist.
+    if plist_get is not None:
+        subject = subject or plist_get("subject")
+        sender = sender or plist_get("sender")
+    sender_name, sender = email.utils.parseaddr(sender or "")
+    recipients = ", ".join(value for value in (_header(headers, "To"), _header(headers, "Cc")) if value)
+
+    if date_sent is None:
+        date = _header(headers, "Date")
+        try:
+            date_sent = int(email.utils.parsedate_to_datetime(date).timestamp()) if date else None
+        except (TypeError, ValueError):
+            pass
+
+    return {
+        "mailbox": os.path.realpath(ref.mailbox.path),
+        "msgid": str(ref.msgid),
+        "partial": int(bool(ref.partial)),
+        "path": os.path.realpath(ref.msg_path),
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "date_sent": date_sent,
+        "date_received": date_received,
+        "flags": flags,
+        "subject": subject,
+        "sender": sender.lower() or None,
+        "sender_name": sender_name or None,
+        "recipients": recipients or None,
+        "message_id": (_header(headers, "Message-ID") or "").strip("<>") or None,
+        "in_reply_to": (_header(headers, "In-Reply-To") or "").strip("<>") or None,
+    }
+
+
+def message_entry(ref):
+    """
+    Returns the catalog row for the message :arg:ref as a dict keyed by
+    :data:`COLUMNS`. Only the headers and the plist are read; the body is
+    left on disk.
+    """
+    if not isinstance(ref, AMMessageRef):
+        # Exported messages have no metadata of their own.
+        msg = ref.get_message()
+        return _entry(ref, msg.parse_headers(email.policy.default), size=msg.content_size)
+
+    st = os.stat(ref.msg_path)
+    msg = EmlxMessage.read_headers(ref.msg_path)
+    return _entry(ref, msg.parse_headers(email.policy.default), msg.date_sent, msg.date_received, msg.flag_word,
+                  msg.plist_get, st.st_size, st.st_mtime_ns)
+
+
+class Catalog(object):
+    """
+    A searchable SQLite catalog of messages, with a row per message holding
+    its plist dates and flags and its main headers. Dates are Unix
+    timestamps and ``flags`` is the raw Apple flags word, so flagged mail is
+    ``flags & EmlxFlags.FLAGGED``. Dates, senders and Message-IDs are
+    indexed.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._db = sqlite3.connect(self.path)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " mailbox TEXT NOT NULL,"
+            " msgid TEXT NOT NULL,"
+            " partial INTEGER NOT NULL,"
+            " path TEXT NOT NULL,"
+            " size INTEGER,"
+            " mtime_ns INTEGER,"
+            " date_sent INTEGER,"
+            " date_received INTEGER,"
+            " flags INTEGER,"
+            " subject TEXT,"
+            " sender TEXT,"
+            " sender_name TEXT,"
+            " recipients TEXT,"
+            " message_id TEXT,"
+            " in_reply_to TEXT,"
+            " PRIMARY KEY (mailbox, msgid, partial))"
+        )
+        for column in ("date_sent", "date_received", "sender", "message_id"):
+            self._db.execute("CREATE INDEX IF NOT EXISTS messages_%s ON messages (%s)" % (column, column))
+        self._db.commit()
+
+    def __repr__(self):
+        return "<Catalog path=%s>" % self.path
+
+    def add(self, entries):
+        """
+        Inserts or replaces the rows in :arg:entries, dicts as returned by
+        :func:`message_entry`.
+        """
+        self._db.executemany(
+            "INSERT OR REPLACE INTO messages (%s) VALUES (%s)" % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+            [tuple(entry[column] for column in COLUMNS) for entry in entries]
+        )
+
+    def index_mailbox(self, mailbox, jobs=INDEX_JOBS):
+        """
+        Replaces the rows of :arg:mailbox with fresh ones for the messages
+        in it now. Returns the number of messages indexed and a list of
+        ``(ref, error)`` pairs for those that could not be read.
+        """
+        failed = []
+
+        def entry(ref):
+            try:
+                return message_entry(ref)
+            except Exception as e:
+                failed.append((ref, repr(e)))
+                return None
+
+        count = 0
+        with self._db:
+            self._db.execute("DELETE FROM messages WHERE mailbox = ?", (os.path.realpath(mailbox.path),))
+            with ThreadPoolExecutor(max(1, jobs)) as executor:
+                batch = []
+                for row in executor.map(entry, mailbox.messages()):
+                    if row is None:
+                        continue
+                    batch.append(row)
+                    if len(batch) >= INSERT_BATCH:
+                        self.add(batch)
+                        count += len(batch)
+                        batch = []
+                self.add(batch)
+                count += len(batch)
+        return count, failed
+
+    def search(self, sender=None, message_id=None, since=None, until=None, flags=None, clear_flags=None,
+               subject=None, limit=None):
+        """
+        Returns the rows matching every criterion given: the sender's
+        address, the Message-ID, a range of received dates (``since``
+        inclusive, ``until`` exclusive, as Unix timestamps), Apple flag bits
+        that must all be set or all be clear and a substring of the subject.
+        Rows come oldest first.
+        """
+        clauses = []
+        params = []
+        if sender is not None:
+            clauses.append("sender = ?")
+            params.append(sender.lower())
+        if message_id is not None:
+            clauses.append("message_id = ?")
+            params.append(message_id.strip("<>"))
+        if since is not None:
+            clauses.append("date_received >= ?")
+            params.append(int(since))
+        if until is not None:
+            clauses.append("date_received < ?")
+            params.append(int(until))
+        if flags:
+            clauses.append("flags & ? = ?")
+            params.extend((int(flags), int(flags)))
+        if clear_flags:
+            clauses.append("flags & ? = 0")
+            params.append(int(clear_flags))
+        if subject is not None:
+            clauses.append("subject LIKE ?")
+            params.append("%" + subject + "%")
+
+        query = "SELECT * FROM messages"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY date_received"
+        if limit is not None:
+            query += " LIMIT %d" % int(limit)
+        return self._db.execute(query, params).fetchall()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
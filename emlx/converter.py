@@ -1,27 +1,38 @@
 #!/usr/bin/env python3.4
 
+import collections
+import functools
+import logging
 import os
+import signal
 import sys
-import time
+from multiprocessing import Pool
 from maildir_lite import Maildir
 
-from emlx.message import EmlxMessage
-from emlx.progress import Progress
+from emlx.dedup import DEDUP_MODES, DEDUP_NAME, SeenSet, message_digest
+from emlx.mailbox import AMMailbox, AMMessageRef
+from emlx.message import DEFAULT_COPY_MODE, EmlxMessage
+from emlx.progress import ProgressMonitor, SharedCounter
+from emlx.stats import Stats, recording, timed
+from emlx.writer import BATCH_SIZE, MaildirWriter
 
 
 def find_mailboxes(path):
+    """
+    Returns an :class:`AMMailbox` for each ``.mbox`` directory at or below
+    :arg:path that is not inside another one; nested mailboxes are reached
+    through their parent's :meth:`AMMailbox.walk`.
+    """
     if os.path.isdir(path) is False:
         return []
-
-    paths = []
-    for root, dirs, files in os.walk(path):
-        if root.endswith(".mbox") and "Info.plist" in files:
-            paths.append(root)
-        
-        for a_dir in dirs:
-            paths.extend(find_mailboxes(a_dir))
+    if path.rstrip(os.sep).endswith(".mbox"):
+        return [AMMailbox(path)]
     
-    return paths
+    boxes = []
+    for dirent in os.scandir(path):
+        if dirent.is_dir():
+            boxes.extend(find_mailboxes(dirent.path))
+    return boxes
 
 
 def import_mailbox(path, destination):
@@ -32,40 +43,333 @@ def import_message(path, mailbox):
     """
     Reads a single message at :arg:path and adds it to the Maildir :arg:mailbox.
     """
-    f = open(path, "rb")
-    data = f.read()
-    f.close()
-    msg = EmlxMessage(data)
-    mailbox.add_message(msg.get_maildir_message())
+    with EmlxMessage.open(path) as msg:
+        mailbox.add_message(msg.get_maildir_message())
 
 
 def enumerate_messages(path):
     """
-    Walks :arg:path and returns a list of all files ending with ``.emlx``.
+    Returns the messages at :arg:path: the path itself if it is a file, or
+    the refs of every message in the mailboxes found below it, whichever
+    layout they are stored in.
     """
     if os.path.isdir(path) is False:
         return [path]
     
-    paths = []
-    for root, dirs, files in os.walk(path):
-        if len(files):
-            paths.extend([os.path.join(root, name) for name in files if name.endswith(".emlx")])
-    return paths
+    messages = []
+    for box in find_mailboxes(path):
+        messages.extend(box.messages())
+        for child in box.walk():
+            messages.extend(child.messages())
+    return messages
 
-from multiprocessing import Pool
-# from multiprocessing.dummy import Pool
 
-def import_msg(path):
-    global maildir, p, last
-    import_message(path, maildir)
-    p.increment()
-    if time.time() > (last + 0.5):
-        last = time.time()
-        p.print_status_line("converting")
+# Messages per task handed to a worker, and so per write batch. Big enough
+# to amortize the IPC and fsyncs, small enough to keep the pool busy at the
+# end of a mailbox.
+CHUNK_SIZE = BATCH_SIZE
 
-def main():
-    global maildir, p, last
+
+def chunked(items, size=CHUNK_SIZE):
+    """
+    Yields lists of up to :arg:size items from :arg:items.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def open_seen(maildir_path, dedup_path=None):
+    """
+    Opens the :class:`SeenSet` at :arg:dedup_path, or the default one in the
+    maildir at :arg:maildir_path.
+    """
+    if dedup_path is None:
+        maildir_path = os.path.expanduser(maildir_path)
+        os.makedirs(maildir_path, exist_ok=True)
+        dedup_path = os.path.join(maildir_path, DEDUP_NAME)
+    return SeenSet(dedup_path)
+
+
+def release_stale_claims(maildir_path, dedup=None, dry_run=False, dedup_path=None, **options):
+    """
+    Releases the dedup claims left in the table at :arg:dedup_path (or the
+    default one in the maildir) by a run that was interrupted, which would
+    otherwise hide their messages for good. Takes the options of
+    :class:`MessageImporter` and does nothing unless they dedup. Must be
+    called before any importer starts writing.
+    """
+    if dedup is None or dry_run:
+        return
+    seen = open_seen(maildir_path, dedup_path)
+    try:
+        seen.release_all()
+    finally:
+        seen.close()
+
+
+class MessageImporter(object):
+    """
+    Per-process conversion state: the destination maildir and a batched
+    writer for each of its folders. If :arg:counter is given, such as a
+    :class:`SharedCounter`, each item is added to it once it is processed.
+    
+    With :arg:dedup set to ``"skip"`` or ``"link"``, messages whose digest
+    (see :class:`MessageHasher` for :arg:dedup_key) was seen before are
+    skipped, or hard linked to the copy already written. The digests are
+    shared with other processes through the table at :arg:dedup_path,
+    which defaults to a file in the maildir, or with other importers in the
+    process through the :class:`SeenSet` :arg:seen.
+    """
+    
+    def __init__(self, maildir_path, fs_layout=False, dry_run=False, fsync="batch", batch_size=BATCH_SIZE,
+                 counter=None, dedup=None, dedup_key="content", dedup_path=None,
+                 copy_mode=DEFAULT_COPY_MODE, seen=None):
+        self.dry_run = dry_run
+        self.copy_mode = copy_mode
+        self.counter = counter
+        if dedup is not None and dedup not in DEDUP_MODES:
+            raise ValueError("dedup must be one of %s" % ", ".join(DEDUP_MODES))
+        self.dedup = dedup
+        self.dedup_key = dedup_key
+        self.seen = None
+        self._claims = set()
+        self._owns_seen = False
+        if dedup is not None and not dry_run:
+            self.seen = seen
+            if seen is None:
+                self.seen = open_seen(maildir_path, dedup_path)
+                self._owns_seen = True
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.maildir = None
+        self.writers = {}
+        if not dry_run:
+            self.maildir = Maildir(maildir_path, create=True, lazy=True, fs_layout=fs_layout)
+    
+    def writer(self, name):
+        if self.maildir is None:
+            return None
+        if name not in self.writers:
+            maildir = self.maildir
+            if name is not None:
+                maildir = maildir.create_folder(name)
+            self.writers[name] = MaildirWriter(maildir.path, batch_size=self.batch_size, fsync=self.fsync,
+                                               copy_mode=self.copy_mode)
+        return self.writers[name]
+    
+    def import_item(self, item, writer):
+        """
+        Imports :arg:item with :arg:writer and returns the path it was
+        written to, or None if it was skipped or this is a dry run.
+        """
+        # Items are AMMessageRefs from a mailbox or bare .emlx paths.
+        if not hasattr(item, "get_message"):
+            if not self.dry_run:
+                with EmlxMessage.open(item) as m:
+                    return self.write(m, writer)
+            return None
+        
+        if self.dry_run:
+            if item.partial:
+                item.get_message()
+            return None
+        
+        # Complete messages need nothing but their body copied across.
+        if isinstance(item, AMMessageRef) and not item.partial:
+            with EmlxMessage.open(item.msg_path) as m:
+                return self.write(m, writer)
+        
+        m = item.get_message()
+        return self.write(m, writer)
     
+    def write(self, msg, writer):
+        """
+        Adds :arg:msg to :arg:writer unless it is a duplicate, in which case
+        it is skipped or linked. Returns the path of the new message, or None
+        if it was skipped. The digest of a new message stays claimed until
+        :meth:`flush` records it.
+        """
+        if self.seen is None:
+            return writer.add_emlx(msg)
+        
+        with timed("dedup", msg.content_size):
+            digest = message_digest(msg, self.dedup_key)
+            existing = self.seen.claim(digest)
+        
+        if existing is None:
+            self._claims.add(digest)
+            try:
+                path = writer.add_emlx(msg, key=digest)
+            except:
+                self._claims.discard(digest)
+                self.seen.release(digest)
+                raise
+            finally:
+                # The message may have filled a batch and moved it into place.
+                self._record(writer.take_moved())
+            return path
+        
+        logging.debug("duplicate of %s" % (existing or "a message being written"))
+        if self.dedup != "link":
+            return None
+        if existing:
+            try:
+                with timed("write", count=0):
+                    return writer.add_link(existing, msg.maildir_flags)
+            except OSError as e:
+                # Gone, or on another filesystem.
+                logging.debug("could not link %s: %r" % (existing, e))
+        return writer.add_emlx(msg)
+    
+    def flush(self, writer):
+        """
+        Moves the messages of :arg:writer into place and records the digests
+        of those that made it. Claims on the rest are released, so a batch
+        that failed to move is written again by a later run.
+        """
+        try:
+            self._record(writer.flush())
+        finally:
+            # What was moved before a failure.
+            self._record(writer.take_moved())
+            self.release_claims()
+    
+    def _record(self, moved):
+        if self.seen is None:
+            return
+        for digest, path in moved:
+            self.seen.record(digest, os.path.abspath(path))
+            self._claims.discard(digest)
+    
+    def release_claims(self):
+        """
+        Releases the claims on messages that have not been moved into place,
+        for when they never will be.
+        """
+        if self.seen is None:
+            return
+        for digest in self._claims:
+            self.seen.release(digest)
+        self._claims.clear()
+    
+    def import_task(self, task):
+        """
+        Imports a ``(folder, items)`` task and flushes the folder's writer,
+        so the whole task is in place when this returns. Returns the number
+        of items processed, a list of ``(item, error)`` pairs for those that
+        failed and the path each item was written to, in the order of the
+        items (None for those that were not written).
+        """
+        folder, items = task
+        writer = self.writer(folder)
+        failed = []
+        paths = [None] * len(items)
+        for i, item in enumerate(items):
+            try:
+                paths[i] = self.import_item(item, writer)
+            except Exception as e:
+                failed.append((item, repr(e)))
+            if self.counter is not None:
+                self.counter.add()
+        
+        if writer is not None:
+            try:
+                self.flush(writer)
+            except EnvironmentError as e:
+                failed_ids = set(id(item) for item, error in failed)
+                failed.extend((item, repr(e)) for item in items if id(item) not in failed_ids)
+        return len(items), failed, paths
+    
+    def close(self):
+        """
+        Releases any claims still held and closes the dedup table if this
+        importer opened it.
+        """
+        self.release_claims()
+        if self._owns_seen:
+            self.seen.close()
+
+
+_importer = None
+
+def _init_worker(maildir_path, options):
+    global _importer
+    # Ctrl-C is handled by the parent, which stops handing out work.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _importer = MessageImporter(maildir_path, **options)
+
+def _import_task(task, timing=False):
+    if not timing:
+        return _importer.import_task(task), None
+    # Each task's totals go back with its result to be merged by the parent.
+    stats = Stats()
+    with recording(stats):
+        result = _importer.import_task(task)
+    return result, stats.as_dict()
+
+
+def import_tasks(tasks, maildir_path, jobs=1, stats=None, **options):
+    """
+    Imports ``(folder, items)`` tasks into the maildir at :arg:maildir_path,
+    yielding each task with its result, in order. With more than one job the
+    tasks are spread over a pool of worker processes. Tasks are only taken
+    from :arg:tasks as workers come free, so a task generator that stops
+    early stops the import once the tasks in flight have finished and been
+    yielded. Closing this generator, or an exception such as a second
+    Ctrl-C, terminates the pool instead. If :arg:stats is a :class:`Stats`,
+    the stages of every task are recorded into it. Other keyword arguments
+    are passed on to :class:`MessageImporter`.
+    """
+    release_stale_claims(maildir_path, **options)
+    
+    if jobs <= 1:
+        importer = MessageImporter(maildir_path, **options)
+        try:
+            for task in tasks:
+                with recording(stats):
+                    result = importer.import_task(task)
+                yield task, result
+        finally:
+            importer.close()
+        return
+    
+    # Enough tasks in flight to keep every worker busy while results are
+    # handed back, and no more.
+    window = jobs * 2
+    pending = collections.deque()
+    run = functools.partial(_import_task, timing=stats is not None)
+    
+    def collect():
+        task, async_result = pending.popleft()
+        result, task_stats = async_result.get()
+        if task_stats is not None:
+            stats.merge(task_stats)
+        return task, result
+    
+    pool = Pool(jobs, initializer=_init_worker, initargs=(maildir_path, options))
+    finished = False
+    try:
+        for task in tasks:
+            pending.append((task, pool.apply_async(run, (task,))))
+            if len(pending) >= window:
+                yield collect()
+        while pending:
+            yield collect()
+        pool.close()
+        finished = True
+    finally:
+        if not finished:
+            pool.terminate()
+        pool.join()
+
+
+def main():
     if len(sys.argv) == 1:
         print("usage: emlx-to-maildir.py path [path ...] maildir")
         print("  Paths can be a mix of emlx files and directories to be searched for emlx files.")
@@ -77,18 +381,11 @@ def main():
 
     output_path = sys.argv[-1:][0]
 
-    maildir = Maildir(output_path, create=True)
-    maildir.lazy = True
-
-    p = Progress(len(input_paths)/4, unit="m")
-    last = time.time()
-    
-    pool = Pool(4)
-    pool.map(import_msg, input_paths)
-    pool.close()
-    pool.join()
-    p.print_status_line()
-
-
-if __name__ == "__main__":
-    main()
+    # Workers count each message as they go; the monitor renders the count.
+    counter = SharedCounter()
+    render = lambda progress: progress.print_status_line("converting")
+    with ProgressMonitor(counter, len(input_paths), unit="m", render=render):
+        tasks = ((None, chunk) for chunk in chunked(input_paths))
+        for task, (count, failed, paths) in import_tasks(tasks, output_path, jobs=os.cpu_count() or 1, counter=counter):
+            for path, error in failed:
+                print("%s: %s" % (path, error))
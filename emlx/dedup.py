@@ -0,0 +1,229 @@
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+
+# Kept in the root of the maildir unless another path is given.
+DEDUP_NAME = ".emlx-dedup.sqlite"
+
+# What to do with a message that has already been written.
+DEDUP_MODES = ("skip", "link")
+
+# What makes two messages the same: their whole content, or their
+# Message-ID and everything after their headers.
+DEDUP_KEYS = ("content", "message-id")
+
+# Bytes read at a time when hashing a message from its file.
+READ_SIZE = 1024 * 1024
+
+# Header blocks longer than this are hashed as part of the body.
+HEADER_LIMIT = 256 * 1024
+
+_blank_line = re.compile(rb"\r?\n\r?\n")
+_message_id = re.compile(rb"^Message-ID:[ \t]*([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)", re.I | re.M)
+
+
+class MessageHasher(object):
+    """
+    A SHA-256 of a message fed to it in pieces with :meth:`update`.
+
+    With ``key="content"`` every byte of the message is hashed. With
+    ``key="message-id"`` the headers are held back until the blank line that
+    ends them, and only the Message-ID is hashed from them, so copies whose
+    headers were rewritten in transit (or by Mail) still match. Messages
+    without a Message-ID are hashed whole.
+    """
+
+    def __init__(self, key="content"):
+        if key not in DEDUP_KEYS:
+            raise ValueError("key must be one of %s" % ", ".join(DEDUP_KEYS))
+        self._hash = hashlib.sha256()
+        self._headers = bytearray() if key == "message-id" else None
+
+    def update(self, data):
+        if self._headers is None:
+            self._hash.update(data)
+            return
+
+        self._headers += data
+        blank = _blank_line.search(self._headers)
+        if blank is not None:
+            self._start_body(blank.start(), blank.end())
+        elif len(self._headers) > HEADER_LIMIT:
+            self._start_body(None, 0)
+
+    def _start_body(self, header_end, body_start):
+        headers, self._headers = self._headers, None
+        match = None
+        if header_end is not None:
+            match = _message_id.search(headers, 0, header_end)
+        if match is None:
+            self._hash.update(headers)
+            return
+        msgid = b" ".join(match.group(1).split())
+        self._hash.update(msgid + b"\0")
+        self._hash.update(memoryview(headers)[body_start:])
+
+    def digest(self):
+        if self._headers is not None:
+            self._start_body(None, 0)
+        return self._hash.digest()
+
+
+def message_digest(msg, key="content"):
+    """
+    Returns the digest of the content of the :class:`EmlxMessage`
+    :arg:msg. The body of an :class:`EmlxReader` is hashed as it is read
+    from its file, without being loaded whole.
+    """
+    hasher = MessageHasher(key)
+    if not hasattr(msg, "body") or msg._content is not None:
+        hasher.update(msg.content)
+        return hasher.digest()
+
+    body = msg.body
+    body.seek(0)
+    buf = bytearray(READ_SIZE)
+    view = memoryview(buf)
+    while True:
+        count = body.readinto(buf)
+        if not count:
+            break
+        hasher.update(view[:count])
+    return hasher.digest()
+
+
+class BloomFilter(object):
+    """
+    A fixed-size Bloom filter over digests, sized for :arg:capacity entries
+    at a false positive rate of :arg:error_rate. Entries must already be
+    uniformly distributed, like the output of a cryptographic hash; the bit
+    positions are taken straight from them.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def __repr__(self):
+        return "<BloomFilter size=%d hashes=%d>" % (self.size, self.hashes)
+
+    def _positions(self, digest):
+        # Double hashing: two 64-bit halves of the digest make every probe.
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, digest):
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest):
+        for position in self._positions(digest):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SeenSet(object):
+    """
+    The digests of the messages written so far, with the maildir path each
+    was written to.
+
+    The digests are kept in a SQLite table that every worker process shares
+    and that persists between runs. A message is claimed in the table before
+    it is written, so two processes never both write the same one. Each
+    process keeps a Bloom filter of the digests it knows of in front of the
+    table, which spares messages it has not seen, the common case, a lookup
+    before their claim. The path is only recorded once the message has been
+    moved into place, so a claim left empty by a run that stopped early is
+    released by :meth:`release_all` at the start of the next.
+
+    A set can be shared by the threads of a process.
+    """
+
+    def __init__(self, path, capacity=1000000):
+        self.path = os.path.expanduser(path)
+        # Every statement commits on its own so claims are seen at once.
+        self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        # Row counts are per connection, so threads take turns with it.
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            " digest BLOB PRIMARY KEY,"
+            " path TEXT NOT NULL)"
+        )
+
+        (count,) = self._db.execute("SELECT COUNT(*) FROM seen").fetchone()
+        self._bloom = BloomFilter(max(capacity, count * 2))
+        for (digest,) in self._db.execute("SELECT digest FROM seen"):
+            self._bloom.add(digest)
+
+    def __repr__(self):
+        return "<SeenSet path=%s>" % self.path
+
+    def lookup(self, digest):
+        """
+        Returns the path recorded for :arg:digest, or None if it has not
+        been seen. The path is empty while the message is still being
+        written.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path FROM seen WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def claim(self, digest):
+        """
+        Claims :arg:digest for a message about to be written. Returns None
+        if the claim succeeded, or the path recorded for the message if it
+        has been seen before.
+        """
+        if digest in self._bloom:
+            path = self.lookup(digest)
+            if path is not None:
+                return path
+        with self._lock:
+            self._bloom.add(digest)
+            cursor = self._db.execute("INSERT OR IGNORE INTO seen (digest, path) VALUES (?, '')", (digest,))
+            claimed = cursor.rowcount != 0
+        if not claimed:
+            # Someone else got there first.
+            return self.lookup(digest) or ""
+        return None
+
+    def record(self, digest, path):
+        """
+        Records :arg:path as where the message claimed with :arg:digest was
+        written.
+        """
+        with self._lock:
+            self._db.execute("UPDATE seen SET path = ? WHERE digest = ?", (path, digest))
+
+    def release(self, digest):
+        """
+        Gives up the claim on :arg:digest, for a message that could not be
+        written.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM seen WHERE digest = ? AND path = ''", (digest,))
+
+    def release_all(self):
+        """
+        Gives up every claim still open, such as those left by a run that
+        was interrupted before its messages were written. Only safe while no
+        other process is writing.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM seen WHERE path = ''")
+
+    def close(self):
+        self._db.close()
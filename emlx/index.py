@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+from emlx.catalog import Catalog, INDEX_JOBS
+from emlx.mailbox import AMMailbox
+from emlx.message import EmlxFlags
+
+
+# Kept in the current directory unless another path is given.
+CATALOG_NAME = "emlx-catalog.sqlite"
+
+
+def _timestamp(value):
+    return time.mktime(datetime.strptime(value, "%Y-%m-%d").timetuple())
+
+
+def main(argc, argv):
+    logging.basicConfig(format="%(message)s", level=logging.WARNING, stream=sys.stdout)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description="indexes Apple Mail mailboxes into a searchable catalog, and searches it",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument("-q", "--quiet",
+                            action="store_true", help="no output")
+    parser.add_argument("-v", "--verbose", default=0,
+                            action="count", help="show per-mailbox progress")
+    parser.add_argument("-d", "--debug",
+                            action="store_true", help="show everything. everything.")
+    parser.add_argument("-i", "--catalog", default=CATALOG_NAME,
+                            help="catalog file to update or search")
+    parser.add_argument("-r", "--recursive",
+                            action="store_true", help="also index all subfolders")
+    parser.add_argument("-j", "--jobs", default=INDEX_JOBS, type=int,
+                            help="number of messages to read at once")
+    parser.add_argument("--from", dest="sender", default=None,
+                            help="search for messages from this address")
+    parser.add_argument("--message-id", default=None,
+                            help="search for the message with this Message-ID")
+    parser.add_argument("--subject", default=None,
+                            help="search for messages whose subject contains this")
+    parser.add_argument("--since", default=None, type=_timestamp,
+                            help="search for messages received on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--until", default=None, type=_timestamp,
+                            help="search for messages received before this date (YYYY-MM-DD)")
+    parser.add_argument("--flagged",
+                            action="store_true", help="search for flagged messages")
+    parser.add_argument("--unread",
+                            action="store_true", help="search for unread messages")
+    parser.add_argument("--limit", default=None, type=int,
+                            help="show at most this many results")
+    parser.add_argument("source", nargs="*",
+                            help="mailboxes to index; without any, the catalog is only searched")
+
+    args = parser.parse_args(argv[1:])
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    elif args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    elif args.quiet:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    catalog = Catalog(args.catalog)
+
+    ### Index the paths
+
+    for path in args.source:
+        if not os.path.isdir(path):
+            logging.warning("path is not a directory: %s", path)
+            continue
+
+        # See if the path is a mailbox container
+        v3_path = os.path.join(path, "V3")
+        if os.path.isdir(v3_path):
+            path = v3_path
+            local_mailboxes = os.path.join(path, "Mailboxes")
+            if os.path.isdir(local_mailboxes):
+                path = local_mailboxes
+
+        mailbox = AMMailbox(path)
+        sources = [mailbox]
+        if args.recursive:
+            sources.extend(mailbox.walk())
+
+        for box in sources:
+            started = time.time()
+            count, failed = catalog.index_mailbox(box, jobs=args.jobs)
+            for msg, error in failed:
+                logging.error("%s: could not index msg %s" % (msg.mailbox.path, msg.msgid))
+                logging.debug("%s: %s" % (msg.msg_path, error))
+            logging.info("%s: indexed %d messages in %.2fs" % (box.name, count, time.time() - started))
+
+    ### Search the catalog
+
+    flags = EmlxFlags.FLAGGED if args.flagged else 0
+    clear_flags = EmlxFlags.READ if args.unread else 0
+    query = (args.sender, args.message_id, args.subject, args.since, args.until)
+    if any(value is not None for value in query) or flags or clear_flags or not args.source:
+        rows = catalog.search(sender=args.sender, message_id=args.message_id, subject=args.subject,
+                              since=args.since, until=args.until, flags=flags, clear_flags=clear_flags,
+                              limit=args.limit)
+        for row in rows:
+            received = ""
+            if row["date_received"] is not None:
+                received = datetime.fromtimestamp(row["date_received"]).strftime("%Y-%m-%d %H:%M")
+            print("\t".join((received, row["sender"] or "", row["subject"] or "", row["path"])))
+
+    catalog.close()
+
+
+def start():
+    sys.exit(main(len(sys.argv), sys.argv))
+
+if __name__ == "__main__":
+    start()
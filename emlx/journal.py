@@ -0,0 +1,90 @@
+import os
+import sqlite3
+
+
+# Kept in the root of the maildir unless another path is given.
+JOURNAL_NAME = ".emlx-journal.sqlite"
+
+
+class Journal(object):
+    """
+    A record of the messages already written to a maildir.
+
+    Messages are keyed by the path of their mailbox and their msgid. Whether
+    they were partial and the size and mtime of the ``.emlx`` file are kept
+    so that a later run can tell whether the message has changed since; a
+    partial message whose download Mail has finished has changed too. The
+    path the message was written to is kept too, so a changed message can
+    replace its old copy.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS imported ("
+            " mailbox TEXT NOT NULL,"
+            " msgid TEXT NOT NULL,"
+            " partial INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " dest TEXT,"
+            " PRIMARY KEY (mailbox, msgid))"
+        )
+
+    def __repr__(self):
+        return "<Journal path=%s>" % self.path
+
+    @staticmethod
+    def mailbox_key(mailbox):
+        return os.path.realpath(mailbox.path)
+
+    def _imported(self, mailbox):
+        rows = self._db.execute(
+            "SELECT msgid, partial, mtime_ns, size, dest FROM imported WHERE mailbox = ?",
+            (self.mailbox_key(mailbox),)
+        )
+        return dict((msgid, ((bool(partial), mtime_ns, size), dest)) for msgid, partial, mtime_ns, size, dest in rows)
+
+    def pending(self, mailbox, refs, sync=False):
+        """
+        Returns ``(ref, (mtime_ns, size), dest)`` tuples for the refs from
+        :arg:mailbox that still need importing. Anything in the journal is
+        skipped, unless :arg:sync is set and its file has changed since, or
+        it was partial and is now complete (or the other way round), in
+        which case ``dest`` is the path its old copy was written to (None
+        for new messages, or if it was not recorded). Files that cannot be
+        stat'ed are left for the importer to report.
+        """
+        imported = self._imported(mailbox)
+        pending = []
+        for ref in refs:
+            try:
+                st = os.stat(ref.msg_path)
+                stamp = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                stamp = None
+            previous, dest = imported.get(str(ref.msgid), (None, None))
+            if previous is not None and (not sync or stamp is not None and previous == (bool(ref.partial),) + stamp):
+                continue
+            pending.append((ref, stamp, dest))
+        return pending
+
+    def record(self, entries):
+        """
+        Records the ``(ref, (mtime_ns, size), dest)`` tuples in
+        :arg:entries as imported, ``dest`` being the path the message was
+        written to, if any.
+        """
+        self._db.executemany(
+            "INSERT OR REPLACE INTO imported (mailbox, msgid, partial, mtime_ns, size, dest) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (self.mailbox_key(ref.mailbox), str(ref.msgid), int(bool(ref.partial))) + stamp + (dest,)
+                for ref, stamp, dest in entries if stamp is not None
+            ]
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
@@ -1,42 +1,58 @@
 import os
 import logging
+from array import array
+from functools import lru_cache
 
 from emlx.message import EmlxMessage
+from emlx.partial import APPLE_MARKER, reassemble
+from emlx.spool import SPOOL_NAME, read_spool_message, spool_extents
+from emlx.stats import timed
 
-# For partial message reassembly
-import email
-from email.policy import EmailPolicy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Just enough to get a regular message back out without
-# significantly altering the message payload.
-minimal_policy = EmailPolicy(linesep="\r\n", refold_source="none")
-APPLE_MARKER = "X-Apple-Content-Length"
+# Directory listings in flight at once when scanning a mailbox.
+SCAN_JOBS = 8
+
+
+@lru_cache(maxsize=4096)
+def trie_branch(prefix):
+    """
+    Returns the trie path, relative to the Data directory, for messages
+    whose ids share :arg:prefix (the id without its last three digits).
+    """
+    if prefix <= 0:
+        return ""
+    return os.path.join(*reversed(str(prefix)))
 
 
 class AMMessageRef(object):
-    mailbox = None
-    msgid = 0
-    partial = False
+    # Inventories hold millions of these.
+    __slots__ = ("mailbox", "msgid", "partial", "messages_dir")
     
     def __repr__(self):
         return "<AMMessageRef msgid=%r partial=%r path=%s>" % (self.msgid, self.partial, self.msg_path)
     
-    def __init__(self, mailbox, msgid, partial=False):
+    def __init__(self, mailbox, msgid, partial=False, messages_dir=None):
         self.mailbox = mailbox
         self.msgid = msgid
         self.partial = partial
+        # The Messages directory the scanner found this in, if it did.
+        self.messages_dir = messages_dir
     
     @property
     def msg_dir(self):
+        if self.messages_dir is not None:
+            return os.path.dirname(self.messages_dir)
+        
         msgid = str(self.msgid)
-        excess = []
-        if len(msgid) > 3:
-            excess = list(msgid)[:-3]
-            excess.reverse()
+        if msgid.isdigit():
+            excess = trie_branch(int(msgid) // 1000)
+        else:
+            excess = ""
         
         path = self.mailbox.messages_path
-        path = os.path.join(path, *excess)
-        return path
+        path = os.path.join(path, excess)
+        return path.rstrip(os.sep)
     
     @property
     def msg_path(self):
@@ -45,8 +61,9 @@ class AMMessageRef(object):
             filename += ".partial"
         filename += ".emlx"
         
-        path = self.msg_dir
-        path = os.path.join(path, "Messages")
+        path = self.messages_dir
+        if path is None:
+            path = os.path.join(self.msg_dir, "Messages")
         path = os.path.join(path, filename)
         return path
     
@@ -56,93 +73,144 @@ class AMMessageRef(object):
         return os.path.join(msg_dir, partname)
     
     def get_message(self):
+        """
+        Reads the message, rebuilding it from its parts if it is partial.
+        ``content`` is ``bytes``; use :meth:`EmlxMessage.from_path` or
+        :meth:`EmlxMessage.open` on ``msg_path`` to avoid the copy.
+        """
         path = self.msg_path
         if path is None or len(path) == 0:
             return None
         
+        # Parse EMLX data straight out of a mapping of the file.
         try:
-            f = open(path, "rb")
-            data = f.read()
-            f.close()
-        except Exception as e:
-            log.exception("get_message: %r", e)
+            msg = EmlxMessage.from_path(path)
+        except EnvironmentError as e:
+            logging.exception("get_message: %r", e)
             return None
         
-        # Parse EMLX data
-        msg = EmlxMessage(data)
-        
         if self.partial:
             logging.debug("%s: rebuilding partial message" % path)
             
-            # Parse the email
-            email_msg = email.message_from_bytes(msg.content, policy=minimal_policy)
-
-            # Iterate over the MIME payloads and look
-            # for the stub header.
-            def load_parts(message, prefix):
-                parts_needed = 0
-                parts_loaded = 0
-                
-                parts = message.get_payload()
-                for part in parts:
-                    partno = parts.index(part) + 1
-                    
-                    if type(part) is str:
-                        continue
-                    
-                    if part.is_multipart():
-                        load_parts(part, "%s.%d" % (prefix, partno))
-                    
-                    elif part[APPLE_MARKER]:
-                        parts_needed += 1
-                        
-                        part_path = "%s.%d.emlxpart" % (prefix, partno)
-                        logging.debug("%s: loading part %d" % (part_path, partno))
-                        
-                        try:
-                            f = open(part_path, "rb")
-                            part_data = f.read()
-                            f.close()
-                            
-                            part.set_payload(part_data)
-                            del part[APPLE_MARKER]
-                            
-                            parts_loaded +=1
-                        
-                        except Exception as e:
-                            logging.error("%s: error loading message part %d" % (path, partno))
-                
-                if parts_loaded != parts_needed:
-                    logging.warning("%s: message may be incomplete (found %d parts of %d)" % (
-                        prefix,
-                        parts_loaded,
-                        parts_needed)
-                    )
-                else:
-                    logging.info("%s: sucessfully reassembled (%d parts)" % (prefix, parts_loaded))
-            
             dir_name = os.path.dirname(path)
             prefix = os.path.join(dir_name, str(self.msgid))
-            load_parts(email_msg, prefix)
+            with timed("reassemble") as t:
+                msg.content, stats = reassemble(msg.content, prefix)
+                t.bytes = stats.bytes_spliced
+            msg.reassembly = stats
             
-            msg_bytes = email_msg.as_bytes()
-            msg.content = msg_bytes
+            if stats.parts_loaded != stats.parts_needed:
+                logging.warning("%s: message may be incomplete (found %d parts of %d)" % (
+                    path,
+                    stats.parts_loaded,
+                    stats.parts_needed)
+                )
+        elif not isinstance(msg.content, bytes):
+            msg.content = bytes(msg.content)
         
         return msg
 
+class AMSpoolRef(object):
+    """
+    A message in the spool of an exported mailbox. It stands in for an
+    :class:`AMMessageRef`; ``msgid`` is its position in the spool.
+    """
+    __slots__ = ("mailbox", "msgid", "offset", "length")
+    partial = False
+    
+    def __repr__(self):
+        return "<AMSpoolRef msgid=%r offset=%d path=%s>" % (self.msgid, self.offset, self.msg_path)
+    
+    def __init__(self, mailbox, msgid, offset, length):
+        self.mailbox = mailbox
+        self.msgid = msgid
+        self.offset = offset
+        self.length = length
+    
+    @property
+    def msg_path(self):
+        return os.path.join(self.mailbox.path, SPOOL_NAME)
+    
+    def get_message(self):
+        msg = EmlxMessage()
+        with timed("read", self.length):
+            msg.content = read_spool_message(self.mailbox.path, self.offset, self.length)
+        msg.content_size = len(msg.content)
+        return msg
+
+
+class MessageRefTable(object):
+    """
+    The messages of one mailbox, stored as columns: msgids in an unsigned
+    64-bit array and the partial flags in a bitmap. Indexing or iterating
+    hands out :class:`AMMessageRef` objects made on demand.
+    """
+    
+    def __init__(self, mailbox, refs=()):
+        self.mailbox = mailbox
+        self.msgids = array("Q")
+        self.partial = bytearray()
+        # Messages directories, stored once and referred to by index.
+        self.dirs = []
+        self.dir_index = array("I")
+        self._dir_numbers = {}
+        for ref in refs:
+            self.append(ref.msgid, ref.partial, ref.messages_dir)
+    
+    def __repr__(self):
+        return "<MessageRefTable mailbox=%r count=%d>" % (self.mailbox, len(self))
+    
+    def __len__(self):
+        return len(self.msgids)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return AMMessageRef(self.mailbox, self.msgids[index], self.is_partial(index), self.dirs[self.dir_index[index]])
+    
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+    
+    def append(self, msgid, partial=False, messages_dir=None):
+        index = len(self.msgids)
+        self.msgids.append(int(msgid))
+        number = self._dir_numbers.get(messages_dir)
+        if number is None:
+            number = self._dir_numbers[messages_dir] = len(self.dirs)
+            self.dirs.append(messages_dir)
+        self.dir_index.append(number)
+        if index % 8 == 0:
+            self.partial.append(0)
+        if partial:
+            self.partial[index >> 3] |= 1 << (index & 7)
+    
+    def is_partial(self, index):
+        return bool(self.partial[index >> 3] & (1 << (index & 7)))
+
+
 # There are three types of mailboxes:
 # 1. The type used by the app for daily operation. This has a trie system for storage and keeps messages in a folder called Messages at the bottom. 
 # 2. An export format where the mbox directory contains a mbox file and a TOC. This file is a standard mailspool file and should be read as such and not modified.
 # 3. An older format where the emlx files are a flat list inside the mbox directory.
 # 
-# Currently, this handles only the first format. It should handle them all. 
+# All three are handled; see the layout property.
 class AMMailbox(object):
     parent = None
     path = None
+    cache = None
     
-    def __init__(self, path, parent=None):
+    def __init__(self, path, parent=None, cache=None):
         self.path = path
         self.parent = parent
+        if cache is None and parent is not None:
+            cache = parent.cache
+        self.cache = cache
+        self._messages = None
+        self._messages_path = False
+        self._layout = None
     
     def __str__(self):
         return str(self.name)
@@ -153,6 +221,14 @@ class AMMailbox(object):
     def __repr__(self):
         return "<AMMailbox name='%s'>" % self.name
     
+    def __getstate__(self):
+        # Refs are pickled along with their mailbox when they are handed to
+        # worker processes; the cache and scan results stay behind.
+        state = self.__dict__.copy()
+        state["cache"] = None
+        state["_messages"] = None
+        return state
+    
     @property
     def name(self):
         path = os.path.normpath(self.path)
@@ -165,71 +241,211 @@ class AMMailbox(object):
     
     @property
     def children(self):
-        boxes = []
-        for dirent in os.scandir(self.path):
-            if dirent.is_dir() and dirent.name[-5:] == ".mbox":
-                boxes.append(AMMailbox(dirent.path, parent=self))
-        return boxes
+        return list(self.iter_children())
     
     @property
     def all_children(self):
-        boxes = []
-        for box in self.children:
-            boxes.append(box)
-            boxes.extend(box.all_children)
-        return boxes
-    
-    def _messages_at_path(self, path):
-        messages_path = os.path.join(path, "Messages")
+        return list(self.walk())
+    
+    def iter_children(self):
+        """
+        Yields the mailboxes directly inside this one.
+        """
+        for (name, is_dir) in self._listdir(self.path):
+            if is_dir and name[-5:] == ".mbox":
+                yield AMMailbox(os.path.join(self.path, name), parent=self)
+    
+    def walk(self):
+        """
+        Yields every mailbox below this one, each before its own children.
+        Only the listings along the current branch are held in memory.
+        """
+        branches = [self.iter_children()]
+        while branches:
+            for box in branches[-1]:
+                yield box
+                branches.append(box.iter_children())
+                break
+            else:
+                branches.pop()
+    
+    def _listdir(self, path):
+        # (name, is_dir) pairs, from the directory cache when there is one.
+        if self.cache is not None:
+            return self.cache.listdir(path)
+        try:
+            return [(dirent.name, dirent.is_dir()) for dirent in os.scandir(path)]
+        except OSError:
+            return []
+    
+    def _scan_branch(self, path):
+        # One listing gives the trie branches below path and its Messages
+        # directory, if it has one.
+        branches = []
+        messages_path = None
+        for (name, is_dir) in self._listdir(path):
+            if name == "Messages":
+                if is_dir:
+                    messages_path = os.path.join(path, name)
+                else:
+                    logging.debug("%s: not a directory; not considering for messages", os.path.join(path, name))
+            elif is_dir and len(name) == 1 and name[0] in "0123456789":
+                branches.append(os.path.join(path, name))
+        return branches, messages_path
+    
+    def _scan_messages(self, messages_path):
         messages = []
-        
-        # logging.debug("looking for messages in %s", messages_path)
-        if os.path.exists(messages_path):
-            if os.path.isdir(messages_path):
-                for dirent in os.scandir(messages_path):
-                    if dirent.is_file():
-                        (name, ext) = os.path.splitext(dirent.name)
-                        if ext == ".emlx":
-                            (msgid, partial) = os.path.splitext(name)
-                            msg = AMMessageRef(self, msgid, partial=(len(partial) != 0))
-                            messages.append(msg)
-                            # logging.debug("FOUND MESSAGE: %s", msg)
-                    
+        for (filename, is_dir) in self._listdir(messages_path):
+            if not is_dir:
+                (name, ext) = os.path.splitext(filename)
+                if ext == ".emlx":
+                    (msgid, partial) = os.path.splitext(name)
+                    if not msgid.isdigit():
+                        logging.debug("%s: not a message id; skipping %s", messages_path, filename)
+                        continue
+                    messages.append(AMMessageRef(self, int(msgid), partial=(len(partial) != 0), messages_dir=messages_path))
+        return messages
+    
+    @property
+    def layout(self):
+        """
+        How the messages are stored: ``"v3"`` for the trie Mail uses day to
+        day, ``"export"`` for a bundle holding an mbox spool or ``"flat"`` for
+        the older layout with the .emlx files directly in the mailbox (or in
+        a Messages directory inside it).
+        """
+        if self._layout is None:
+            entries = self._listdir(self.path)
+            if (SPOOL_NAME, False) in entries:
+                self._layout = "export"
+            elif self.messages_path is not None:
+                self._layout = "v3"
+            elif ("Messages", True) in entries or any(
+                    not is_dir and name.endswith(".emlx") for (name, is_dir) in entries):
+                self._layout = "flat"
             else:
-                logging.debug("%s: not a directory; not considering for messages", messages_path)
+                self._layout = "v3"
+        return self._layout
+    
+    def _scan_spool(self):
+        # The table of contents gives the offset of every message, so the
+        # spool itself is not read until a message is.
+        for msgid, (offset, length) in enumerate(spool_extents(self.path), 1):
+            yield AMSpoolRef(self, msgid, offset, length)
+    
+    def scan(self, jobs=SCAN_JOBS):
+        """
+        Yields the messages in this mailbox as they are found. Trie branches
+        are listed concurrently on a pool of :arg:jobs threads, which keeps
+        a slow (network or spinning) disk busy with several requests at once.
+        """
+        if self.layout == "export":
+            for msg in self._scan_spool():
+                yield msg
+            return
         
-        # Scan for tries and get their messages
-        for dirent in os.scandir(path):
-            if len(dirent.name) == 1 and dirent.name[0] in "0123456789":
-                # logging.debug(" inspecting trie %s", dirent.name)
-                trie_branch = os.path.join(path, dirent.name)
-                messages.extend(self._messages_at_path(trie_branch))
+        if self.layout == "flat":
+            # Everything is in one directory: a single listing finds it all.
+            messages_path = self.path
+            if ("Messages", True) in self._listdir(self.path):
+                messages_path = os.path.join(self.path, "Messages")
+            for msg in self._scan_messages(messages_path):
+                yield msg
+            if self.cache is not None:
+                self.cache.commit()
+            return
         
-        # logging.debug("found %d messages at %s", len(messages), messages_path)
-        return messages
+        data_dir = self.messages_path
+        if data_dir is None:
+            # logging.debug("%s: no messages found", self.path)
+            return
+        
+        pool = ThreadPoolExecutor(max(1, jobs))
+        pending = set([pool.submit(self._scan_branch, data_dir)])
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if isinstance(result, tuple):
+                        branches, messages_path = result
+                        for branch in branches:
+                            pending.add(pool.submit(self._scan_branch, branch))
+                        if messages_path is not None:
+                            pending.add(pool.submit(self._scan_messages, messages_path))
+                    else:
+                        for msg in result:
+                            yield msg
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown()
+            if self.cache is not None:
+                self.cache.commit()
     
     @property
     def messages_path(self):
+        # False until the GUID directory has been looked for.
+        if self._messages_path is not False:
+            return self._messages_path
+        
         data_dir = None
         # Our messages will be in a dir named with a GUID.
-        for dirent in os.scandir(self.path):
+        for (name, is_dir) in self._listdir(self.path):
             # GUID or GUID.noindex
-            if len(dirent.name) == 36 or len(dirent.name) == 44:
-                # logging.debug("looking for Data in %s", dirent.name)
-                data_path = os.path.join(dirent.path, "Data")
-                if os.path.isdir(data_path):
-                    data_dir = data_path
+            if len(name) == 36 or len(name) == 44:
+                # logging.debug("looking for Data in %s", name)
+                guid_path = os.path.join(self.path, name)
+                if ("Data", True) in self._listdir(guid_path):
+                    data_dir = os.path.join(guid_path, "Data")
                     break
+        self._messages_path = data_dir
         return data_dir
     
     def messages(self):
-        data_dir = self.messages_path
-                
-        if data_dir is None:
-            # logging.debug("%s: no messages found", self.path)
-            return []
-        
-        messages = self._messages_at_path(data_dir)
+        """
+        Returns the messages in this mailbox as a :class:`MessageRefTable`,
+        or a list of :class:`AMSpoolRef` for an exported mailbox. The scan is
+        done once per instance; call :meth:`refresh` to pick up changes on
+        disk.
+        """
+        if self._messages is None:
+            with timed("scan") as t:
+                if self.layout == "export":
+                    self._messages = list(self.scan())
+                else:
+                    self._messages = MessageRefTable(self, self.scan())
+                t.count = len(self._messages)
+            # logging.debug("found %d messages", len(self._messages))
+        return self._messages
+    
+    def iter_messages(self, partial=None, min_msgid=None, max_msgid=None):
+        """
+        Yields the messages in this mailbox without collecting them first.
+        Set :arg:partial to True or False for only partial or only complete
+        messages, and :arg:min_msgid / :arg:max_msgid for an inclusive range
+        of message ids.
+        """
+        if self._messages is not None:
+            messages = iter(self._messages)
+        else:
+            messages = self.scan()
         
-        # logging.debug("found %d messages", len(messages))
-        return messages
+        for msg in messages:
+            if partial is not None and msg.partial != partial:
+                continue
+            if min_msgid is not None or max_msgid is not None:
+                msgid = int(msg.msgid)
+                if min_msgid is not None and msgid < min_msgid:
+                    continue
+                if max_msgid is not None and msgid > max_msgid:
+                    continue
+            yield msg
+    
+    def refresh(self):
+        """
+        Forgets the result of the last scan.
+        """
+        self._messages = None
+        self._messages_path = False
+        self._layout = None
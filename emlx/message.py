@@ -1,46 +1,276 @@
 #!/usr/bin/env python
 
 import plistlib  # 3.4+
+import enum
+import io
 import logging
+import mmap
+import os
+import re
+import shutil
+import struct
+from email.parser import BytesHeaderParser
+from email.policy import compat32
 from maildir_lite import MaildirMessage
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from emlx.stats import timed
+
+
+# The length header is a short decimal line; anything longer is not an emlx.
+HEADER_MAX = 64
+
+# Header blocks are read from files in pieces of this size, and cut off at
+# the limit if no blank line turns up.
+HEADER_CHUNK = 8192
+HEADER_BLOCK_MAX = 256 * 1024
+
+_header_end = re.compile(rb"\r?\n\r?\n")
+
+# Ways of copying a message body out of its file, fastest first. Each one
+# falls back to those after it.
+COPY_MODES = ("clone", "copy_file_range", "sendfile", "read")
+
+# Cloning only applies to messages that start on a block boundary, which
+# .emlx bodies, after their length line, almost never do, so it is only
+# tried when asked for.
+DEFAULT_COPY_MODE = "copy_file_range"
+
+# ioctl(2) request that shares a block-aligned range of one file with
+# another on filesystems with reflinks (btrfs, XFS); see ioctl_ficlonerange(2).
+FICLONERANGE = 0x4020940d
+
+# Integer keys read on every conversion or index, matched straight out of XML plists.
+_PLIST_INTEGER = re.compile(rb"<key>(flags|date-received|date-sent)</key>\s*<integer>(-?\d+)</integer>")
+
+
+def parse_length_header(data):
+    """
+    Parses the byte-count line at the start of :arg:data. Returns the size of
+    the message and the offset at which the message starts.
+    """
+    newline = bytes(data[:HEADER_MAX]).find(b"\n")
+    if newline < 0:
+        raise ValueError("missing emlx length header")
+    return int(bytes(data[:newline])), newline + 1
+
+
+def header_block_end(data):
+    """
+    Returns the offset just past the blank line that ends the headers at the
+    start of :arg:data, or None if :arg:data holds no blank line.
+    """
+    if data[:1] == b"\n":
+        return 1
+    if data[:2] == b"\r\n":
+        return 2
+    match = _header_end.search(data)
+    if match is None:
+        return None
+    return match.end()
+
+
+def scan_plist_integers(data):
+    """
+    Pulls the ``flags``, ``date-received`` and ``date-sent`` integers out of
+    the XML plist :arg:data without building the plist. Keys that are
+    missing or stored in another form are left out of the result.
+    """
+    values = {}
+    for match in _PLIST_INTEGER.finditer(data):
+        values[match.group(1).decode("ascii")] = int(match.group(2))
+    return values
+
+
+class EmlxFlags(enum.IntFlag):
+    """
+    The bits of the ``flags`` word in an emlx plist. ``ATTACHMENTS``,
+    ``PRIORITY`` and ``FONT_SIZE_DELTA`` are multi-bit fields; read them
+    through the properties of the same name.
+    """
+    READ                    = 1 << 0
+    DELETED                 = 1 << 1
+    ANSWERED                = 1 << 2
+    ENCRYPTED               = 1 << 3
+    FLAGGED                 = 1 << 4
+    RECENT                  = 1 << 5
+    DRAFT                   = 1 << 6
+    INITIAL                 = 1 << 7
+    FORWARDED               = 1 << 8
+    REDIRECTED              = 1 << 9
+    ATTACHMENTS             = 0x3f << 10 # (6 bits)
+    PRIORITY                = 0x7f << 16 # (7 bits)
+    SIGNED                  = 1 << 23
+    JUNK                    = 1 << 24
+    NOT_JUNK                = 1 << 25
+    FONT_SIZE_DELTA         = 0x7 << 26 # (3 bits)
+    JUNK_SET                = 1 << 29
+    HIGHLIGHT_TEXT_IN_TOC   = 1 << 30
+    UNUSED                  = 1 << 31
+    
+    @property
+    def attachments(self):
+        return (int(self) >> 10) & 0x3f
+    
+    @property
+    def priority(self):
+        return (int(self) >> 16) & 0x7f
+    
+    @property
+    def font_size_delta(self):
+        return (int(self) >> 26) & 0x7
+
+
+def _maildir_flags(word):
+    flags = ""
+    if word & EmlxFlags.DRAFT:
+        flags += 'D'
+    if word & EmlxFlags.FLAGGED:
+        flags += 'F'
+    if word & (EmlxFlags.FORWARDED | EmlxFlags.REDIRECTED):
+        flags += 'P'
+    if word & EmlxFlags.ANSWERED:
+        flags += 'R'
+    if word & EmlxFlags.READ:
+        flags += 'S'
+    if word & EmlxFlags.DELETED:
+        flags += 'T'
+    return flags
+
+# Every maildir flag comes from the low ten bits of the Apple flags word, so
+# mapping a message's flags is a single lookup in this table.
+MAILDIR_FLAG_MASK = 0x3ff
+MAILDIR_FLAGS = tuple(_maildir_flags(word) for word in range(MAILDIR_FLAG_MASK + 1))
+
 
 class EmlxMessage(object):
     content = b""
     content_size = 0
-    plist = {}
+    _plist = None
+    _plist_data = b""
+    _plist_scan = None
+    _apple_flags = None
+    _flags = None
+    _header_block = None
+    _headers = None
+    # ReassemblyStats for a rebuilt partial message.
+    reassembly = None
     
     def __init__(self, message=None):
         if isinstance(message, bytes):
-            # The size of the message is the first line of the file.
-            first_line = message.split(b"\n")[0]
-            self.content_size = int(first_line)
-            if self.content_size is 0:
-                return
-            
-            # Read in the message portion.
-            start = len(first_line) + 1
-            end = start + self.content_size
-            if start > 0 and end > 0:
-                self.content = message[start:end]
-            
-            # Read in the plist metadata at the end.
-            if start > 0 and end > 0:
-                meta = message[end:]
-                try:
-                    self.plist = plistlib.loads(meta)
-                except:
-                    logging.error("failed to parse message metadata plist")
+            self._parse(message)
+        elif isinstance(message, (bytearray, memoryview, mmap.mmap)):
+            # Parse buffers in place: content and the metadata are views
+            # into the caller's buffer rather than copies of it.
+            self._parse(memoryview(message))
+    
+    @classmethod
+    def from_path(cls, path):
+        """
+        Maps the file at :arg:path and parses it without reading it into
+        memory. ``content`` is a :class:`memoryview` of the mapping rather
+        than ``bytes``. An empty file gives an empty message.
+        """
+        with timed("read") as t, open(path, "rb") as f:
+            t.bytes = os.fstat(f.fileno()).st_size
+            if t.bytes == 0:
+                return cls()
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data)
+    
+    @classmethod
+    def open(cls, path):
+        """
+        Opens the file at :arg:path for streaming. Only the length header is
+        read up front; see :class:`EmlxReader`.
+        """
+        return EmlxReader(path)
+    
+    @classmethod
+    def read_headers(cls, path):
+        """
+        Reads the headers and the plist of the file at :arg:path and nothing
+        else: the file is read up to the blank line after the headers, the
+        plist is read with a seek to the tail, and the file is closed. The
+        returned :class:`EmlxReader` answers ``headers``, ``flags`` and the
+        dates but can no longer read ``content``.
+        """
+        with EmlxReader(path) as msg:
+            msg.header_block
+            msg._plist_data
+        return msg
+    
+    def _parse(self, message):
+        # The size of the message is the first line of the file.
+        self.content_size, start = parse_length_header(message)
+        if self.content_size == 0:
+            return
+        
+        # Read in the message portion.
+        end = start + self.content_size
+        self.content = message[start:end]
+        
+        # Keep the plist metadata at the end; it is decoded on first use.
+        self._plist_data = message[end:]
+    
+    @property
+    def plist(self):
+        if self._plist is None:
+            self._plist = {}
+            if self._plist_data:
+                with timed("plist", len(self._plist_data)):
+                    try:
+                        self._plist = plistlib.loads(self._plist_data)
+                    except:
+                        logging.error("failed to parse message metadata plist")
+            self._plist_data = b""
+        return self._plist
+    
+    @plist.setter
+    def plist(self, value):
+        self._plist = value
+        self._apple_flags = None
+        self._flags = None
+    
+    def _plist_value(self, key):
+        # Answer from the scanner until something needs the full plist.
+        if self._plist is None:
+            if self._plist_scan is None:
+                data = self._plist_data
+                with timed("plist", len(data)):
+                    self._plist_scan = scan_plist_integers(data)
+            if key in self._plist_scan:
+                return self._plist_scan[key]
+        
+        plist = self.plist
+        if key in plist:
+            return plist[key]
+        return None
+    
+    def plist_get(self, key, default=None):
+        """
+        Returns the value of :arg:key in the plist metadata, or :arg:default
+        if it has none. Integer values are read without decoding the whole
+        plist.
+        """
+        value = self._plist_value(key)
+        if value is None:
+            return default
+        return value
     
     def __str__(self):
         if not self.content:
             return ""
-        return str(self.content)
+        return str(bytes(self.content))
     
     def __bytes__(self):
         content_size = str(len(self.content)).encode("utf8")
         meta = plistlib.dumps(self.plist)
-        return (content_size + b"\n" + self.content + meta)
+        return b"".join((content_size, b"\n", self.content, meta))
     
     def as_string(self, *args, **kwargs):
         return str(self)
@@ -48,86 +278,341 @@ class EmlxMessage(object):
     def as_bytes(self, *args, **kwargs):
         return bytes(self)
     
+    @property
+    def flag_word(self):
+        """
+        The raw Apple flags word from the plist, or None if there isn't one.
+        """
+        flags = self._plist_value('flags')
+        if flags is not None:
+            flags = int(flags)
+        return flags
+    
+    @property
+    def apple_flags(self):
+        """
+        The Apple flags as :class:`EmlxFlags`, or None if there are none.
+        """
+        if self._apple_flags is None:
+            word = self.flag_word
+            if word is not None:
+                self._apple_flags = EmlxFlags(word)
+        return self._apple_flags
+    
     @property
     def flags(self):
-        attrs = {}
-        
-        if 'flags' in self.plist:
-            flags = int(self.plist['flags'])
-            attrs['read']               = (flags & 1 << 0) > 0
-            attrs['deleted']            = (flags & 1 << 1) > 0
-            attrs['answered']           = (flags & 1 << 2) > 0
-            attrs['encrypted']          = (flags & 1 << 3) > 0
-            attrs['flagged']            = (flags & 1 << 4) > 0
-            attrs['recent']             = (flags & 1 << 5) > 0
-            attrs['draft']              = (flags & 1 << 6) > 0
-            attrs['initial']            = (flags & 1 << 7) > 0
-            attrs['forwarded']          = (flags & 1 << 8) > 0
-            attrs['redirected']         = (flags & 1 << 9) > 0
-            attrs['attachments']        = (flags & 3 << 10) >> 10 # (6 bits)
-            attrs['priority']           = (flags & 7 << 16) >> 16 # (7 bits)
-            attrs['signed']             = (flags & 1 << 23) > 0
-            attrs['junk']               = (flags & 1 << 24) > 0
-            attrs['not junk']           = (flags & 1 << 25) > 0
-            attrs['font size delta']    = (flags & 7 << 26) >> 7 # (3 bits)
-            attrs['junk set']           = (flags & 1 << 29) > 0
-            attrs['highlight text in toc'] = (flags & 1 << 30) > 0
-            attrs['(unused)']           = (flags & 1 << 31) > 0
+        if self._flags is None:
+            attrs = {}
+            
+            flags = self.apple_flags
+            if flags is not None:
+                attrs['read']               = EmlxFlags.READ in flags
+                attrs['deleted']            = EmlxFlags.DELETED in flags
+                attrs['answered']           = EmlxFlags.ANSWERED in flags
+                attrs['encrypted']          = EmlxFlags.ENCRYPTED in flags
+                attrs['flagged']            = EmlxFlags.FLAGGED in flags
+                attrs['recent']             = EmlxFlags.RECENT in flags
+                attrs['draft']              = EmlxFlags.DRAFT in flags
+                attrs['initial']            = EmlxFlags.INITIAL in flags
+                attrs['forwarded']          = EmlxFlags.FORWARDED in flags
+                attrs['redirected']         = EmlxFlags.REDIRECTED in flags
+                attrs['attachments']        = flags.attachments
+                attrs['priority']           = flags.priority
+                attrs['signed']             = EmlxFlags.SIGNED in flags
+                attrs['junk']               = EmlxFlags.JUNK in flags
+                attrs['not junk']           = EmlxFlags.NOT_JUNK in flags
+                attrs['font size delta']    = flags.font_size_delta
+                attrs['junk set']           = EmlxFlags.JUNK_SET in flags
+                attrs['highlight text in toc'] = EmlxFlags.HIGHLIGHT_TEXT_IN_TOC in flags
+                attrs['(unused)']           = EmlxFlags.UNUSED in flags
             
-        return attrs
+            self._flags = attrs
+        return self._flags
     
     @property
     def date_sent(self):
-        date = None
-        DATE_SENT = 'date-sent'
-        if DATE_SENT in self.plist and self.plist[DATE_SENT] is not 0:
-            date = self.plist[DATE_SENT]
+        date = self._plist_value('date-sent')
+        if date == 0:
+            date = None
         return date
 
     @property
     def date_received(self):
-        date = None
-        DATE_RECEIVED = 'date-received'
-        if DATE_RECEIVED in self.plist and self.plist[DATE_RECEIVED] is not 0:
-            date = self.plist[DATE_RECEIVED]
+        date = self._plist_value('date-received')
+        if date == 0:
+            date = None
         return date
 
     @property
     def date_last_viewed(self):
-        date = None
-        DATE_LAST_VIEWED = 'date-last-viewed'
-        if DATE_LAST_VIEWED in self.plist and self.plist[DATE_LAST_VIEWED] is not 0:
-            date = self.plist[DATE_LAST_VIEWED]
+        date = self._plist_value('date-last-viewed')
+        if date == 0:
+            date = None
         return date
     
+    @property
+    def maildir_flags(self):
+        """
+        The maildir info flags for the message, e.g. ``"RS"``. If the plist
+        failed to parse there are none; we do lose state there, but there's
+        little to be done at that point.
+        """
+        word = self.flag_word
+        if word is None:
+            return ""
+        return MAILDIR_FLAGS[word & MAILDIR_FLAG_MASK]
+    
+    @property
+    def header_block(self):
+        """
+        The raw RFC822 headers of the message, up to and including the blank
+        line that ends them.
+        """
+        if self._header_block is None:
+            self._header_block = self._read_header_block()
+        return self._header_block
+    
+    def _read_header_block(self):
+        content = self.content
+        end = header_block_end(content)
+        if end is None:
+            end = len(content)
+        return bytes(content[:end])
+    
+    def parse_headers(self, policy=compat32):
+        """
+        Parses :attr:`header_block` with :class:`email.parser.BytesHeaderParser`
+        under :arg:policy and returns the headers as an
+        :class:`email.message.Message` with no body.
+        """
+        return BytesHeaderParser(policy=policy).parsebytes(self.header_block)
+    
+    @property
+    def headers(self):
+        """
+        The headers of the message, parsed without touching the body.
+        """
+        if self._headers is None:
+            self._headers = self.parse_headers()
+        return self._headers
+    
     def get_maildir_message(self):
-        m = MaildirMessage(self.content)
+        m = MaildirMessage(bytes(self.content))
         
         if self.date_received is not None:
             m.set_date(self.date_received)
         
-        flags_dict = self.flags
+        for flag in self.maildir_flags:
+            m.add_flag(flag)
         
-        # If the plist failed to parse, this will be empty.
-        # We do lose state here, but there's little to be done
-        # at this point.
-        if len(flags_dict) == 0:
-            return m
+        return m
+
+
+class EmlxBody(io.RawIOBase):
+    """
+    A read-only file object over the message range of an open emlx file.
+    """
+    
+    def __init__(self, f, offset, size):
+        self._file = f
+        self.offset = offset
+        self.size = size
+        self._pos = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+    
+    def readinto(self, b):
+        count = min(len(b), self.size - self._pos)
+        if count <= 0:
+            return 0
+        self._file.seek(self.offset + self._pos)
+        count = self._file.readinto(memoryview(b)[:count])
+        self._pos += count
+        return count
+
+
+class EmlxReader(EmlxMessage):
+    """
+    An emlx file opened for streaming. Only the length header is read when
+    the file is opened; ``body`` is a file object limited to the message and
+    the plist is read with one seek to the tail when it is first needed.
+    Reading ``content`` loads the whole message, so bulk copies should use
+    ``body`` or :meth:`copy_body` instead, and ``headers`` reads no further
+    than the end of the headers.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb", buffering=0)
+        try:
+            with timed("read") as t:
+                header = self._file.read(HEADER_MAX)
+                t.bytes = len(header)
+            self.content_size, offset = parse_length_header(header)
+        except:
+            self._file.close()
+            raise
+        self.body = EmlxBody(self._file, offset, self.content_size)
+        self._content = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        self._file.close()
+    
+    @property
+    def content(self):
+        if self._content is None:
+            with timed("read", self.content_size, count=0):
+                self.body.seek(0)
+                self._content = self.body.read()
+        return self._content
+    
+    @content.setter
+    def content(self, value):
+        self._content = value
+    
+    def _read_header_block(self):
+        if self._content is not None:
+            return EmlxMessage._read_header_block(self)
         
-        if flags_dict['draft']:
-            m.add_flag('D')
-        if flags_dict['flagged']:
-            m.add_flag('F')
-        if flags_dict['forwarded'] or flags_dict['redirected']:
-            m.add_flag('P')
-        if flags_dict['answered']:
-            m.add_flag('R')
-        if flags_dict['read']:
-            m.add_flag('S')
-        if flags_dict['deleted']:
-            m.add_flag('T')
+        with timed("read", count=0) as t:
+            self.body.seek(0)
+            data = b""
+            while len(data) < HEADER_BLOCK_MAX:
+                chunk = self.body.read(HEADER_CHUNK)
+                if not chunk:
+                    break
+                data += chunk
+                end = header_block_end(data)
+                if end is not None:
+                    data = data[:end]
+                    break
+            t.bytes = len(data)
+        return data
+    
+    @property
+    def _plist_data(self):
+        data = self.__dict__.get("_plist_data")
+        if data is None:
+            data = b""
+            if self.content_size != 0:
+                with timed("read", count=0) as t:
+                    self._file.seek(self.body.offset + self.body.size)
+                    data = self._file.read()
+                    t.bytes = len(data)
+            self.__dict__["_plist_data"] = data
+        return data
+    
+    @_plist_data.setter
+    def _plist_data(self, value):
+        self.__dict__["_plist_data"] = value
+    
+    def copy_body(self, fdst, mode=DEFAULT_COPY_MODE):
+        """
+        Copies the message to the file object :arg:fdst without loading it.
+        :arg:mode names the first method in :data:`COPY_MODES` to try, and
+        the ones after it are used for whatever is left:
+
+        - ``clone`` shares the blocks with the source on filesystems with
+          reflinks. It only works when the message starts on a block
+          boundary, so it covers whole blocks and leaves the tail.
+        - ``copy_file_range`` copies in the kernel, letting the filesystem
+          share or copy extents as it can.
+        - ``sendfile`` copies in the kernel without touching the filesystem.
+        - ``read`` reads and writes through Python.
+        """
+        if mode not in COPY_MODES:
+            raise ValueError("mode must be one of %s" % ", ".join(COPY_MODES))
+        if self._content is not None:
+            fdst.write(self._content)
+            return
         
-        return m
+        try:
+            out_fd = fdst.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            mode = "read"
+        
+        copied = 0
+        if mode != "read":
+            fdst.flush()
+            for method in COPY_MODES[COPY_MODES.index(mode):-1]:
+                copied = getattr(self, "_%s" % method)(out_fd, copied)
+                if copied >= self.body.size:
+                    return
+        
+        self.body.seek(copied)
+        shutil.copyfileobj(self.body, fdst)
+    
+    # Each of these copies what it can from :arg:copied onwards to the
+    # current position of out_fd and returns how much of the body is done.
+    
+    def _clone(self, out_fd, copied):
+        if fcntl is None or copied != 0:
+            return copied
+        in_fd = self._file.fileno()
+        block = os.fstat(in_fd).st_blksize
+        out_offset = os.lseek(out_fd, 0, os.SEEK_CUR)
+        length = self.body.size - self.body.size % block
+        if length == 0 or self.body.offset % block or out_offset % block:
+            return copied
+        try:
+            fcntl.ioctl(out_fd, FICLONERANGE, struct.pack("qQQQ", in_fd, self.body.offset, length, out_offset))
+        except OSError:
+            # No reflinks here, or the files are on different filesystems.
+            return copied
+        os.lseek(out_fd, out_offset + length, os.SEEK_SET)
+        return length
+    
+    def _copy_file_range(self, out_fd, copied):
+        if not hasattr(os, "copy_file_range"):
+            return copied
+        try:
+            while copied < self.body.size:
+                count = os.copy_file_range(self._file.fileno(), out_fd, self.body.size - copied,
+                                           self.body.offset + copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            # Not supported between these files; carry on from here.
+            pass
+        return copied
+    
+    def _sendfile(self, out_fd, copied):
+        if not hasattr(os, "sendfile"):
+            return copied
+        try:
+            while copied < self.body.size:
+                count = os.sendfile(out_fd, self._file.fileno(), self.body.offset + copied,
+                                    self.body.size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            # Not supported for regular files here (e.g. macOS); carry on
+            # from wherever sendfile stopped.
+            pass
+        return copied
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,145 @@
+import collections
+import re
+from email.parser import BytesHeaderParser
+
+# Header Mail.app leaves on parts whose bodies were not downloaded.
+APPLE_MARKER = "X-Apple-Content-Length"
+
+_header_parser = BytesHeaderParser()
+_blank_line = re.compile(rb"\r?\n\r?\n")
+_marker_line = re.compile(rb"^" + APPLE_MARKER.encode("ascii") + rb":[^\n]*(?:\n|$)(?:[ \t][^\n]*(?:\n|$))*", re.I | re.M)
+
+
+def _entity_bounds(data, start, end):
+    # Returns where the headers of the entity in data[start:end] end and
+    # where its body begins.
+    if data[start:start + 1] == b"\n":
+        return start, start + 1
+    if data[start:start + 2] == b"\r\n":
+        return start, start + 2
+
+    blank = _blank_line.search(data, start, end)
+    if blank is None:
+        # Headers only, without even the blank line that ends them.
+        return end, None
+    # Keep the line ending of the last header with the headers.
+    header_end = blank.start() + (2 if data[blank.start():blank.start() + 1] == b"\r" else 1)
+    return header_end, blank.end()
+
+
+def _parts(data, body_start, end, boundary):
+    # Yields the (start, end) range of each part between the delimiters.
+    delimiter = re.compile(rb"^--" + re.escape(boundary) + rb"(--)?[ \t]*\r?$", re.M)
+    previous = None
+    for match in delimiter.finditer(data, body_start, end):
+        if previous is not None:
+            part_start = previous.end() + 1
+            # The line ending before a delimiter belongs to the delimiter.
+            part_end = match.start() - 1
+            if data[part_end - 1:part_end] == b"\r":
+                part_end -= 1
+            yield part_start, max(part_start, part_end)
+        if match.group(1):
+            return
+        previous = match
+
+
+ReassemblyStats = collections.namedtuple("ReassemblyStats", "parts_needed parts_loaded bytes_spliced missing")
+ReassemblyStats.__doc__ = """
+What reassembling a partial message took: the number of stub parts found
+and filled in, the bytes spliced in from part files and the paths of the
+part files that could not be read.
+"""
+
+
+def _multipart_boundary(headers):
+    if headers.get_content_maintype() != "multipart":
+        return None
+    boundary = headers.get_boundary()
+    if not boundary:
+        return None
+    return boundary.encode("ascii", "surrogateescape")
+
+
+def _stub_parts(data, prefix):
+    # Walks the MIME tree once, without recursion, and returns the stub
+    # parts as (part file, part start, part end, header end, body start).
+    stubs = []
+    header_end, body_start = _entity_bounds(data, 0, len(data))
+    boundary = _multipart_boundary(_header_parser.parsebytes(bytes(data[:header_end])))
+    if boundary is None or body_start is None:
+        return stubs
+
+    pending = [(body_start, len(data), boundary, prefix)]
+    while pending:
+        body_start, end, boundary, prefix = pending.pop()
+        for partno, (part_start, part_end) in enumerate(_parts(data, body_start, end, boundary), 1):
+            part_prefix = "%s.%d" % (prefix, partno)
+            part_header_end, part_body_start = _entity_bounds(data, part_start, part_end)
+            part_headers = _header_parser.parsebytes(bytes(data[part_start:part_header_end]))
+
+            part_boundary = _multipart_boundary(part_headers)
+            if part_boundary is not None:
+                if part_body_start is not None:
+                    pending.append((part_body_start, part_end, part_boundary, part_prefix))
+            elif part_headers[APPLE_MARKER]:
+                stubs.append(("%s.emlxpart" % part_prefix, part_start, part_end, part_header_end, part_body_start))
+    return stubs
+
+
+def reassemble(data, prefix):
+    """
+    Rebuilds the partial message :arg:data by splicing in the ``.emlxpart``
+    files named after :arg:prefix (the message's path without ``.emlx``).
+    Returns the message bytes and a :class:`ReassemblyStats`.
+
+    Only the MIME headers are parsed. The original bytes are copied as they
+    are, with the stub parts' bodies replaced by the contents of their part
+    files and their ``X-Apple-Content-Length`` headers removed.
+    """
+    stubs = _stub_parts(data, prefix)
+
+    # Read every part file for the message in one go.
+    contents = {}
+    missing = []
+    for part_path, part_start, part_end, part_header_end, part_body_start in stubs:
+        try:
+            with open(part_path, "rb") as f:
+                contents[part_path] = f.read()
+        except EnvironmentError:
+            missing.append(part_path)
+
+    splices = []
+    for part_path, part_start, part_end, part_header_end, part_body_start in stubs:
+        part_data = contents.get(part_path)
+        if part_data is None:
+            continue
+
+        marker = _marker_line.search(data, part_start, part_header_end)
+        if marker is not None:
+            splices.append((marker.start(), marker.end(), b""))
+        if part_body_start is None:
+            # Add the blank line the stub went without, matching the
+            # line endings of the delimiter that follows it.
+            newline = b"\r\n" if data[part_end:part_end + 1] == b"\r" else b"\n"
+            if marker is None or marker.end() != part_end:
+                newline += newline
+            part_body_start = part_end
+            part_data = newline + part_data
+        splices.append((part_body_start, part_end, part_data))
+
+    stats = ReassemblyStats(
+        parts_needed=len(stubs),
+        parts_loaded=len(contents),
+        bytes_spliced=sum(len(part_data) for part_data in contents.values()),
+        missing=missing,
+    )
+
+    chunks = []
+    position = 0
+    for start, end, replacement in sorted(splices, key=lambda splice: splice[0]):
+        chunks.append(data[position:start])
+        chunks.append(replacement)
+        position = end
+    chunks.append(data[position:])
+    return b"".join(chunks), stats
@@ -46,7 +46,10 @@ __version__ = "1.0.0"
 
 import time
 import math
+import multiprocessing
 import sys
+import threading
+from collections import deque
 
 # When _gather_stats is true, every time a Progress class is used to completion
 # it will log statistics to ~/.progress_stats
@@ -58,6 +61,10 @@ if _gather_stats:
 MULTI_LINE = 0
 SINGLE_LINE = 1
 
+# History entries kept for rate estimates. Entries are at least a second
+# apart, so this covers the last minute or so of work.
+HISTORY_SIZE = 64
+
 def _time():
     """Return time in seconds. I made a separate function so I can easily
     simulate an OS where that number is only accurate to the nearest second.
@@ -177,7 +184,7 @@ class Progress:
             self.computer_prefix = unit.lower() in ["b", "bit", "byte"]
         else:
             self.computer_prefix = computer_prefix
-        self.history = []
+        self.history = deque(maxlen=HISTORY_SIZE)
         if _gather_stats:
             self.stats_written = False
             self.log = []
@@ -213,10 +220,13 @@ class Progress:
             # (work, t) because the new entry will likely be replaced later.
             delta_t = float(self.history[-1][1] - self.history[-2][1])
             delta_w = self.history[-1][0] - self.history[-2][0]
-            rate = delta_t / delta_w
-            self.pes_squares += rate * rate
-            self.pes_total += rate
-            self.pes_samples += 1
+            # A monitor polling on a timer can see no work done between two
+            # entries; a stall has no time per unit of work to sample.
+            if delta_w:
+                rate = delta_t / delta_w
+                self.pes_squares += rate * rate
+                self.pes_total += rate
+                self.pes_samples += 1
 
         if replace:
             self.history[-1] = history_entry
@@ -242,9 +252,13 @@ class Progress:
             stats_file.close()
             self.stats_written = True
 
-    def increment(self):
-        """Increments the work completed by 1 unit."""
-        self.update(self.history[-1][0] + 1)
+    def increment(self, work=1):
+        """Increments the work completed by 'work' units."""
+        self.update(self.history[-1][0] + work)
+
+    def work_done(self):
+        """Returns the units of work completed so far."""
+        return self.history[-1][0]
 
     def percentage(self):
         """Returns the percent of work completed so far."""
@@ -266,8 +280,8 @@ class Progress:
         work_done = self.history[-1][0]
         remaining_work = self.total_work - work_done
         # Drop all old history entries.
-        while work_done - self.history[1][0] > remaining_work:
-            self.history.pop(0)
+        while len(self.history) > 2 and work_done - self.history[1][0] > remaining_work:
+            self.history.popleft()
         return float(self.history[-1][0] - self.history[0][0]) / \
                 (self.history[-1][1] - self.history[0][1])
 
@@ -291,6 +305,9 @@ class Progress:
         """
         if len(self.history) < 3:
            return self._predicted_rate_avg()
+        # Every update so far came while no work was being done.
+        if not self.pes_samples:
+            return self._predicted_rate_avg()
         avg = self.pes_total / self.pes_samples
         stddev = math.sqrt(self.pes_squares / self.pes_samples - avg * avg)
         return 1.0 / (avg + stddev * self.percentage() / 100)
@@ -337,7 +354,8 @@ class Progress:
         """Returns the estimated amount of time (in seconds) remaining until
         all the work is complete."""
         work_rate = self.predicted_rate()
-        if work_rate is None:
+        # No work done yet: there is nothing to estimate from.
+        if not work_rate:
             return -1
         remaining_work = self.total_work - self.history[-1][0]
         work_time_remaining = remaining_work / work_rate
@@ -431,6 +449,85 @@ class Progress:
                     average[i]*average[i])
         return list(zip(average, stddev))
 
+class SharedCounter:
+    """A count of work done that any thread or process can add to. It lives
+    in shared memory, so it has to reach worker processes when they are
+    started, e.g. through a Pool initializer, rather than through a queue.
+    """
+    def __init__(self, value=0):
+        self._value = multiprocessing.Value("Q", value)
+
+    def add(self, work=1):
+        """Adds 'work' units to the count."""
+        with self._value.get_lock():
+            self._value.value += work
+
+    @property
+    def value(self):
+        return self._value.value
+
+class ProgressMonitor:
+    """Follows a SharedCounter from a background thread and renders the
+    progress at most once every 'interval' seconds, so whatever drives the
+    counter pays only for the addition.
+
+    monitor = ProgressMonitor(counter, task_size, "file")
+    with monitor:
+        run_workers(counter)
+    """
+    def __init__(self, counter, total_work, unit=None, interval=0.5, render=None):
+        """Create a new monitor.
+        'counter' is the SharedCounter the work is counted in.
+        'total_work' and 'unit' are passed on to the Progress it keeps.
+        'render' is called with that Progress to show it, and defaults to
+        printing a status line.
+        """
+        self.counter = counter
+        self.progress = Progress(total_work, unit)
+        self.interval = interval
+        if render is None:
+            render = Progress.print_status_line
+        self.render = render
+        self._last = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def poll(self, force=False):
+        """Brings the progress up to date with the counter and renders it,
+        unless it was rendered less than 'interval' seconds ago."""
+        now = _time()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        self.progress.update(self.counter.value)
+        self.render(self.progress)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll(force=True)
+
+    def start(self):
+        """Starts rendering from a background thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and renders the final count."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.poll(force=True)
+
 class ProgressDisplay:
     """Wraps an iterator and displays progress every time next() is called.
     In order to show progress, it computes the total size of the data by
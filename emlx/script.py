@@ -6,12 +6,36 @@ import os
 import sys
 import time
 
-from maildir_lite import Maildir
+from emlx.cache import DirectoryCache
+from emlx.converter import chunked, import_tasks
+from emlx.dedup import DEDUP_KEYS, DEDUP_MODES
+from emlx.journal import Journal, JOURNAL_NAME
 from emlx.mailbox import AMMailbox
+from emlx.message import COPY_MODES, DEFAULT_COPY_MODE
+from emlx.progress import ProgressMonitor, SharedCounter
+from emlx.stats import Stats, STATS_FORMATS, recording
+from emlx.writer import BATCH_SIZE, FSYNC_MODES
 
 from clint.textui import progress, colored
 
 
+def replace_previous(previous, path):
+    """
+    Removes :arg:previous, the old copy of a message synced again to
+    :arg:path, and returns the absolute path the journal should record.
+    A message that was skipped as a duplicate keeps its old copy.
+    """
+    if path is None:
+        return previous
+    path = os.path.abspath(path)
+    if previous is not None and previous != path:
+        try:
+            os.unlink(previous)
+        except FileNotFoundError:
+            pass
+    return path
+
+
 def main(argc, argv):
     global STOP
     
@@ -39,6 +63,32 @@ def main(argc, argv):
                             action="store_true", help="preserve folder structure (only makes sense with --recursive)")
     parser.add_argument("-l", "--fs",
                             action="store_true", help="use FS layout for maildir subfolders instead of Maildir++")
+    parser.add_argument("-c", "--cache", default=None,
+                            help="file to keep mailbox directory listings in, so rescans of unchanged mailboxes are quick")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count() or 1, type=int,
+                            help="number of worker processes to convert messages with")
+    parser.add_argument("--fsync", default="batch", choices=FSYNC_MODES,
+                            help="when to fsync written messages: never, once per batch or for each message")
+    parser.add_argument("--batch-size", default=BATCH_SIZE, type=int,
+                            help="number of messages written and moved into place together")
+    parser.add_argument("--copy-mode", default=DEFAULT_COPY_MODE, choices=COPY_MODES,
+                            help="first way to try when copying messages: reflink clone (only for block-aligned messages), copy_file_range, sendfile or read")
+    parser.add_argument("--resume",
+                            action="store_true", help="skip messages already imported by an earlier run")
+    parser.add_argument("--sync",
+                            action="store_true", help="import only messages that are new or have changed since an earlier run")
+    parser.add_argument("--journal", default=None,
+                            help="file recording imported messages for --resume and --sync (default: in the maildir)")
+    parser.add_argument("--dedup", default=None, choices=DEDUP_MODES,
+                            help="skip or hard link messages whose content has already been written")
+    parser.add_argument("--dedup-key", default="content", choices=DEDUP_KEYS,
+                            help="what makes messages duplicates: their whole content, or their Message-ID and body")
+    parser.add_argument("--dedup-db", default=None,
+                            help="file recording written messages for --dedup (default: in the maildir)")
+    parser.add_argument("--stats", default=None,
+                            help="file to write per-stage timings, byte and message counts to at the end (- for stdout)")
+    parser.add_argument("--stats-format", default="json", choices=STATS_FORMATS,
+                            help="format of the --stats file")
     parser.add_argument("source", nargs="+")
     
     args = parser.parse_args()
@@ -59,6 +109,23 @@ def main(argc, argv):
         paths = [os.path.expanduser("~/Library/Mail/")]
     
     
+    cache = None
+    if args.cache:
+        cache = DirectoryCache(args.cache)
+    
+    journal = None
+    if (args.resume or args.sync) and not args.dry_run:
+        journal_path = args.journal
+        if journal_path is None:
+            maildir_path = os.path.expanduser(args.maildir)
+            os.makedirs(maildir_path, exist_ok=True)
+            journal_path = os.path.join(maildir_path, JOURNAL_NAME)
+        journal = Journal(journal_path)
+    
+    stats = None
+    if args.stats:
+        stats = Stats()
+    
     ### Process the paths
     
     for path in paths:
@@ -79,8 +146,9 @@ def main(argc, argv):
         # Load what should be a mailbox at this point
         logging.info("processing source path: %s", path)
         
-        mailboxes = AMMailbox(path)
-        logging.info("%s: found %d messages.", str(mailboxes), len(mailboxes.messages()))
+        mailboxes = AMMailbox(path, cache=cache)
+        with recording(stats):
+            logging.info("%s: found %d messages.", str(mailboxes), len(mailboxes.messages()))
         
         sources = [mailboxes]
         if args.recursive:
@@ -91,42 +159,84 @@ def main(argc, argv):
         #     logging.warning("no mailboxes found")
         #     sys.exit()
         
-        # Scan for the total number of messags to import.
+        # Work out what to import from each mailbox, and the total.
+        work = []
+        stamps = {}
         total_count = 0
         for box in sources:
-            total_count += len(box.messages())
+            with recording(stats):
+                refs = box.messages()
+            if journal is not None:
+                pending = journal.pending(box, refs, sync=args.sync)
+                logging.info("%s: %d of %d messages already imported" % (
+                    box.name, len(refs) - len(pending), len(refs)))
+                refs = [ref for ref, stamp, dest in pending]
+                stamps.update((id(ref), (stamp, dest)) for ref, stamp, dest in pending)
+            work.append((box, refs))
+            total_count += len(refs)
         
         # if total_count == 0:
         #     logging.warning("no messages found")
         #     sys.exit()
         
-        if args.dry_run == False:
-            maildir = Maildir(args.maildir, create=True, lazy=True, fs_layout=args.fs)
+        def tasks():
+            for box, refs in work:
+                logging.info("%s: starting import" % box.name)
+                
+                folder = None
+                if args.preserve:
+                    folder = box.name
+                logging.info("writing messages to %s" % (folder or args.maildir))
+                
+                for chunk in chunked(refs, args.batch_size):
+                    if STOP:
+                        return
+                    yield (folder, chunk)
         
-        for box in sources:
-            logging.info("%s: starting import" % box.name)
-            
-            if STOP:
-                break
-            
-            if args.preserve:
-                box_maildir = maildir.create_folder(box.name)
-            else:
-                box_maildir = maildir
-            logging.info("writing messages to %s" % box_maildir.name)
-            
-            for msg in progress.bar(box.messages(), expected_size=len(box.messages()), label="Importing %s: " % box.name, every=250):
-                if STOP:
-                    break
-                if args.dry_run == False:
-                    try:
-                        m = msg.get_message()
-                        box_maildir.add_message(m.get_maildir_message())
-                    except:
-                        logging.error("%s: invalid emlx file (msg %s)" % (path, msg.msgid))
-                else:
-                    if msg.partial:
-                        m = msg.get_message()
+        # Workers count messages as they finish them; the bar is redrawn from
+        # that count on a timer rather than for every result.
+        bar = progress.Bar(label="Importing: ", expected_size=total_count, every=1)
+        counter = SharedCounter()
+        monitor = ProgressMonitor(counter, total_count, render=lambda p: bar.show(p.work_done()))
+        monitor.start()
+        results = import_tasks(tasks(), args.maildir, jobs=args.jobs, fs_layout=args.fs, dry_run=args.dry_run,
+                               fsync=args.fsync, batch_size=args.batch_size, stats=stats, counter=counter,
+                               dedup=args.dedup, dedup_key=args.dedup_key, dedup_path=args.dedup_db,
+                               copy_mode=args.copy_mode)
+        try:
+            for (folder, chunk), (count, failed, paths) in results:
+                for msg, error in failed:
+                    logging.error("%s: invalid emlx file (msg %s)" % (msg.mailbox.path, msg.msgid))
+                    logging.debug("%s: %s" % (msg.msg_path, error))
+                if journal is not None:
+                    failed_ids = set((msg.msgid, msg.partial) for msg, error in failed)
+                    entries = []
+                    for msg, path in zip(chunk, paths):
+                        if (msg.msgid, msg.partial) in failed_ids:
+                            continue
+                        stamp, previous = stamps[id(msg)]
+                        entries.append((msg, stamp, replace_previous(previous, path)))
+                    journal.record(entries)
+        finally:
+            results.close()
+            monitor.stop()
+            bar.done()
+        if STOP:
+            break
+    
+    if cache is not None:
+        cache.close()
+    if journal is not None:
+        journal.close()
+    
+    if stats is not None:
+        for name, stage in stats.stages.items():
+            logging.info("%s: %d items, %d bytes in %.3fs" % (name, stage.count, stage.bytes, stage.seconds))
+        if args.stats == "-":
+            stats.dump(sys.stdout, args.stats_format)
+        else:
+            with open(args.stats, "w") as f:
+                stats.dump(f, args.stats_format)
                     
 
 def start():
@@ -136,8 +246,10 @@ def start():
     def signal_handler(sig, frame):
         global STOP
         if STOP:
+            # Asked twice: give up on the messages in flight.
             signal.signal(signal.SIGINT, signal.SIG_IGN)
-            os.kill(os.getpid(), signal.SIGTERM)
+            raise KeyboardInterrupt
+        # Finish the messages in flight, then stop.
         STOP = True
     signal.signal(signal.SIGINT, signal_handler)
     
@@ -146,7 +258,10 @@ def start():
     argc = len(sys.argv)
     argv = sys.argv
     
-    sys.exit(main(argc, argv))
+    try:
+        sys.exit(main(argc, argv))
+    except KeyboardInterrupt:
+        sys.exit(130)
     
 if __name__ == "__main__":
     start()
@@ -0,0 +1,128 @@
+import mmap
+import os
+import re
+import struct
+
+# Files inside an exported .mbox bundle.
+SPOOL_NAME = "mbox"
+TOC_NAME = "table_of_contents"
+
+_quoted_from = re.compile(rb"^>(>*From )", re.M)
+# A From line at the start of the spool or after a blank line, which is
+# where every message but a malformed one starts.
+_separator = re.compile(rb"(?:\A|\n\r?\n)From ")
+
+
+def _is_from_line(spool, offset):
+    return spool[offset:offset + 5] == b"From " and (offset == 0 or spool[offset - 1:offset] == b"\n")
+
+
+def toc_offsets(toc, spool):
+    """
+    Returns the offsets of the messages in :arg:spool that are listed in
+    :arg:toc, the bundle's ``table_of_contents``.
+
+    The layout of the table is not documented. It holds the spool offset of
+    each message as a 32-bit integer, so every aligned word is tried as an
+    offset in both byte orders and kept only if it points at a ``From `` line
+    past the last offset kept. The byte order that finds more messages wins.
+
+    Stray words can point at a From line too, so the offsets are checked
+    without reading the spool through: they must start it, come one per
+    record of the same size with none after the last, and follow a blank
+    line, and the last message must not hold another. Otherwise the table
+    was not understood and an empty list is returned.
+    """
+    usable = len(toc) - len(toc) % 4
+    words = usable // 4
+    best = []
+    best_indexes = []
+    for order in (">I", "<I"):
+        offsets = []
+        indexes = []
+        for index, (offset,) in enumerate(struct.iter_unpack(order, toc[:usable])):
+            if offsets and offset <= offsets[-1]:
+                continue
+            if offset < len(spool) and _is_from_line(spool, offset):
+                offsets.append(offset)
+                indexes.append(index)
+        if len(offsets) > len(best):
+            best = offsets
+            best_indexes = indexes
+
+    if not best or best[0] != 0:
+        return []
+    if len(best) > 1:
+        stride = best_indexes[1] - best_indexes[0]
+        if any(b - a != stride for a, b in zip(best_indexes, best_indexes[1:])):
+            return []
+        if words - best_indexes[-1] > stride:
+            return []
+    for offset in best[1:]:
+        if spool[offset - 2:offset] != b"\n\n" and spool[offset - 3:offset] != b"\n\r\n":
+            return []
+    # A table cut short by messages added since shows up in the last one.
+    if _separator.search(spool, best[-1] + 1) is not None:
+        return []
+    return best
+
+
+def scan_offsets(spool):
+    """
+    Returns the offsets of the ``From `` lines that start each message in
+    :arg:spool, searching the whole spool. A From line only starts a message
+    at the start of the spool or after a blank line; one anywhere else
+    belongs to the body it is in.
+    """
+    return [match.end() - 5 for match in _separator.finditer(spool)]
+
+
+def spool_extents(path):
+    """
+    Returns ``(offset, length)`` for each message in the exported mailbox at
+    :arg:path, from its table of contents where that can be read and by
+    searching the spool otherwise.
+    """
+    spool_path = os.path.join(path, SPOOL_NAME)
+    size = os.path.getsize(spool_path)
+    if size == 0:
+        return []
+
+    with open(spool_path, "rb") as f:
+        spool = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offsets = []
+        try:
+            with open(os.path.join(path, TOC_NAME), "rb") as f:
+                offsets = toc_offsets(f.read(), spool)
+        except EnvironmentError:
+            pass
+        if not offsets:
+            offsets = scan_offsets(spool)
+    finally:
+        spool.close()
+
+    ends = offsets[1:] + [size]
+    return [(start, end - start) for start, end in zip(offsets, ends)]
+
+
+def read_spool_message(path, offset, length):
+    """
+    Reads the message at :arg:offset in the spool of the exported mailbox
+    at :arg:path and returns it without its ``From `` line, the blank line
+    that separates it from the next message or the quoting of ``From `` lines
+    in its body.
+    """
+    with open(os.path.join(path, SPOOL_NAME), "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    newline = data.find(b"\n")
+    data = data[newline + 1:] if newline >= 0 else b""
+    if data.endswith(b"\n\n"):
+        data = data[:-1]
+    elif data.endswith(b"\r\n\r\n"):
+        data = data[:-2]
+    if b"\n>" in data or data.startswith(b">"):
+        data = _quoted_from.sub(rb"\1", data)
+    return data
@@ -0,0 +1,185 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# The stages of a conversion, in the order a message goes through them.
+STAGES = ("scan", "read", "plist", "reassemble", "dedup", "write")
+
+STATS_FORMATS = ("json", "prometheus")
+
+_local = threading.local()
+
+
+class StageStats(object):
+    """
+    The totals for one stage: the items (messages, or plists for ``plist``)
+    it handled, the wall time spent in it and the bytes it moved.
+    """
+    __slots__ = ("count", "seconds", "bytes")
+
+    def __init__(self, count=0, seconds=0.0, bytes=0):
+        self.count = count
+        self.seconds = seconds
+        self.bytes = bytes
+
+    def __repr__(self):
+        return "<StageStats count=%d seconds=%.6f bytes=%d>" % (self.count, self.seconds, self.bytes)
+
+    def as_dict(self):
+        return {"count": self.count, "seconds": self.seconds, "bytes": self.bytes}
+
+
+class _Timing(object):
+    # What a timed block reports when it ends; the block may change the
+    # count and bytes before then.
+    __slots__ = ("count", "bytes")
+
+    def __init__(self, count, nbytes):
+        self.count = count
+        self.bytes = nbytes
+
+
+class Stats(object):
+    """
+    Per-stage totals for a conversion. Stages are timed with :meth:`time`
+    and totals from other threads or processes are folded in with
+    :meth:`merge`. Times are summed over every worker, so with several jobs
+    they add up to more than the wall time of the run.
+    """
+
+    def __init__(self):
+        self.stages = dict((name, StageStats()) for name in STAGES)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Stats %s>" % " ".join("%s=%d" % (name, stage.count) for name, stage in self.stages.items())
+
+    def __getstate__(self):
+        return self.as_dict()
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.merge(state)
+
+    def add(self, name, seconds, nbytes=0, count=1):
+        """
+        Adds :arg:count items to the stage :arg:name that took
+        :arg:seconds and moved :arg:nbytes.
+        """
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageStats()
+            stage.count += count
+            stage.seconds += seconds
+            stage.bytes += nbytes
+
+    @contextmanager
+    def time(self, name, nbytes=0, count=1):
+        """
+        Times the block as a run of the stage :arg:name. The block can set
+        ``bytes`` and ``count`` on the object it is given once it knows them.
+        """
+        timing = _Timing(count, nbytes)
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            self.add(name, time.perf_counter() - start, timing.bytes, timing.count)
+
+    def merge(self, other):
+        """
+        Adds the totals of :arg:other, a :class:`Stats` or the result of its
+        :meth:`as_dict`.
+        """
+        if isinstance(other, Stats):
+            other = other.as_dict()
+        for name, stage in other.items():
+            self.add(name, stage["seconds"], stage["bytes"], stage["count"])
+
+    def as_dict(self):
+        with self._lock:
+            return dict((name, stage.as_dict()) for name, stage in self.stages.items())
+
+    def to_json(self):
+        return json.dumps({"stages": self.as_dict()}, indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix="emlx"):
+        """
+        Returns the totals in the Prometheus text exposition format, with
+        the stage as a label.
+        """
+        stages = sorted(self.as_dict().items())
+        metrics = (
+            ("stage_items_total", "count", "Items handled by each conversion stage."),
+            ("stage_seconds_total", "seconds", "Wall time spent in each conversion stage."),
+            ("stage_bytes_total", "bytes", "Bytes moved by each conversion stage."),
+        )
+        lines = []
+        for metric, key, help in metrics:
+            metric = "%s_%s" % (prefix, metric)
+            lines.append("# HELP %s %s" % (metric, help))
+            lines.append("# TYPE %s counter" % metric)
+            for name, stage in stages:
+                lines.append('%s{stage="%s"} %s' % (metric, name, repr(stage[key])))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, f, format="json"):
+        """
+        Writes the totals to the file object :arg:f as JSON or Prometheus text.
+        """
+        if format not in STATS_FORMATS:
+            raise ValueError("format must be one of %s" % ", ".join(STATS_FORMATS))
+        if format == "json":
+            f.write(self.to_json() + "\n")
+        else:
+            f.write(self.to_prometheus())
+
+
+def current():
+    """
+    Returns the :class:`Stats` being recorded into on this thread, or None.
+    """
+    return getattr(_local, "stats", None)
+
+
+@contextmanager
+def recording(stats):
+    """
+    Records the stages timed on this thread into :arg:stats for the
+    duration of the block.
+    """
+    previous = current()
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+class _NullTiming(object):
+    __slots__ = ("count", "bytes")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timing = _NullTiming()
+
+
+def timed(name, nbytes=0, count=1):
+    """
+    Times a block as a run of the stage :arg:name if this thread is
+    recording, and costs next to nothing if it is not::
+
+        with timed("read") as t:
+            data = f.read()
+            t.bytes = len(data)
+    """
+    stats = current()
+    if stats is None:
+        return _null_timing
+    return stats.time(name, nbytes, count)
@@ -0,0 +1,233 @@
+import itertools
+import os
+import socket
+import time
+
+from emlx.message import DEFAULT_COPY_MODE
+from emlx.stats import timed
+
+# How many messages, and how many bytes, to hold before a batch is flushed.
+BATCH_SIZE = 64
+BATCH_BYTES = 32 * 1024 * 1024
+
+# When to fsync: never, once per batch, or for every message.
+FSYNC_MODES = ("none", "batch", "each")
+
+# Shared by every writer in the process, so names stay unique when several
+# writers fill the same maildir.
+_deliveries = itertools.count(1)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MaildirWriter(object):
+    """
+    Writes messages into the maildir directory at ``path`` in batches.
+
+    Each message is written to ``tmp/`` straight away, but the files are
+    only moved into ``new/`` (or ``cur/`` when they carry flags) when the
+    batch is flushed. With ``fsync="batch"`` the files of a batch are synced
+    together before the renames and each destination directory is synced
+    once afterwards; ``"each"`` syncs every message on its own and
+    ``"none"`` leaves it to the OS. Files are closed once written and only
+    reopened to be synced, so a batch holds no descriptors open and its
+    size is not bound by the open file limit.
+
+    ``copy_mode`` is the first method :meth:`EmlxReader.copy_body` tries
+    when a message body is copied from its ``.emlx`` file.
+
+    Messages can be added with a ``key``; :meth:`flush` and
+    :meth:`take_moved` hand back the keys of the messages that have been
+    moved into place, so callers can record what was written only once it
+    is really there.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE, batch_bytes=BATCH_BYTES, fsync="batch",
+                 copy_mode=DEFAULT_COPY_MODE):
+        if fsync not in FSYNC_MODES:
+            raise ValueError("fsync must be one of %s" % ", ".join(FSYNC_MODES))
+        self.path = os.path.expanduser(path)
+        self.copy_mode = copy_mode
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.fsync = fsync
+        self._hostname = socket.gethostname().replace("/", r"\057").replace(":", r"\072")
+        self._pending = []
+        self._pending_bytes = 0
+        self._moved = []
+        for subdir in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(self.path, subdir), exist_ok=True)
+
+    def __repr__(self):
+        return "<MaildirWriter path=%s pending=%d>" % (self.path, len(self._pending))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def unique_name(self):
+        """
+        Returns a new unique file name for a message in this maildir.
+        """
+        now = time.time()
+        return "%d.M%dP%dQ%d.%s" % (int(now), int(now % 1 * 1e6), os.getpid(), next(_deliveries), self._hostname)
+
+    def _destination(self, name, flags):
+        if flags:
+            return os.path.join(self.path, "cur", "%s:2,%s" % (name, "".join(sorted(flags))))
+        return os.path.join(self.path, "new", name)
+
+    def _create(self):
+        name = self.unique_name()
+        tmp_path = os.path.join(self.path, "tmp", name)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        return name, tmp_path, fd
+
+    def add(self, data, flags="", date=None, key=None):
+        """
+        Adds the message :arg:data with the maildir :arg:flags (e.g. ``"RS"``)
+        and, if given, sets its mtime to the timestamp :arg:date. Returns the
+        path the message will have once its batch is flushed.
+        """
+        with timed("write", len(data)):
+            name, tmp_path, fd = self._create()
+            try:
+                view = memoryview(data)
+                while view:
+                    written = os.write(fd, view)
+                    view = view[written:]
+            except:
+                os.close(fd)
+                os.unlink(tmp_path)
+                raise
+        return self._queue(fd, tmp_path, self._destination(name, flags), date, len(data), key)
+
+    def add_emlx(self, msg, key=None):
+        """
+        Adds the :class:`EmlxMessage` :arg:msg with its flags and received
+        date. The body of an :class:`EmlxReader` is copied straight from its
+        file into the maildir without being read into memory, and shares
+        its blocks where the filesystem allows. Returns the
+        path the message will have once its batch is flushed.
+        """
+        flags = msg.maildir_flags
+        date = msg.date_received
+        if not hasattr(msg, "copy_body"):
+            return self.add(msg.content, flags, date, key)
+
+        with timed("write", msg.content_size):
+            name, tmp_path, fd = self._create()
+            try:
+                with open(fd, "wb", closefd=False) as f:
+                    msg.copy_body(f, self.copy_mode)
+            except:
+                os.close(fd)
+                os.unlink(tmp_path)
+                raise
+        return self._queue(fd, tmp_path, self._destination(name, flags), date, msg.content_size, key)
+
+    def add_link(self, source, flags=""):
+        """
+        Adds a hard link to the message at :arg:source, a path returned by
+        :meth:`add` or :meth:`add_emlx` of any writer on the same filesystem,
+        with the maildir :arg:flags. A message still waiting for its batch to
+        be flushed is linked from ``tmp/``. Raises :class:`OSError` if the
+        message cannot be linked. Returns the path the link will have once
+        its batch is flushed.
+        """
+        name = self.unique_name()
+        tmp_path = os.path.join(self.path, "tmp", name)
+        pending = os.path.join(os.path.dirname(os.path.dirname(source)), "tmp",
+                               os.path.basename(source).split(":", 1)[0])
+        # The source can be renamed into place between the attempts.
+        for candidate in (source, pending, source):
+            try:
+                os.link(candidate, tmp_path)
+                break
+            except FileNotFoundError as e:
+                error = e
+        else:
+            raise error
+        fd = os.open(tmp_path, os.O_RDONLY)
+        # The mtime belongs to the shared file, so it is left alone.
+        return self._queue(fd, tmp_path, self._destination(name, flags), None, 0, None)
+
+    def _queue(self, fd, tmp_path, dest_path, date, size, key):
+        if date is not None:
+            os.utime(fd if os.utime in os.supports_fd else tmp_path, (date, date))
+
+        if self.fsync == "each":
+            with timed("write", count=0):
+                os.fsync(fd)
+                os.close(fd)
+                os.rename(tmp_path, dest_path)
+                _fsync_dir(os.path.dirname(dest_path))
+            if key is not None:
+                self._moved.append((key, dest_path))
+            return dest_path
+
+        os.close(fd)
+        self._pending.append((tmp_path, dest_path, key))
+        self._pending_bytes += size
+        if len(self._pending) >= self.batch_size or self._pending_bytes >= self.batch_bytes:
+            self._flush()
+        return dest_path
+
+    def flush(self):
+        """
+        Moves every message written since the last flush into place. Returns
+        the ``(key, path)`` pairs of the messages added with a key that have
+        been moved into place since the last call, including those moved by
+        batches that filled up. If moving a batch fails, the messages moved
+        before the failure are returned by the next call.
+        """
+        self._flush()
+        return self.take_moved()
+
+    def take_moved(self):
+        """
+        Returns the ``(key, path)`` pairs of the messages added with a key
+        that have been moved into place since the last call, by batches that
+        filled up or by :meth:`flush`.
+        """
+        moved, self._moved = self._moved, []
+        return moved
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        self._pending_bytes = 0
+        if not pending:
+            return
+        with timed("write", count=0):
+            self._move(pending)
+
+    def _move(self, pending):
+        if self.fsync == "batch":
+            for tmp_path, dest_path, key in pending:
+                fd = os.open(tmp_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        dirs = set()
+        for tmp_path, dest_path, key in pending:
+            os.rename(tmp_path, dest_path)
+            dirs.add(os.path.dirname(dest_path))
+            if key is not None:
+                self._moved.append((key, dest_path))
+
+        if self.fsync == "batch":
+            for path in dirs:
+                _fsync_dir(path)
+
+    def close(self):
+        self.flush()
@@ -75,6 +75,7 @@ setup(
     entry_points={
         'console_scripts': [
             'emlx-to-maildir=emlx.script:start',
+            'emlx-index=emlx.index:start',
         ],
     },
 )
@@ -0,0 +1,156 @@
+import email
+from email.policy import EmailPolicy
+
+from emlx.partial import APPLE_MARKER, reassemble
+
+
+def write_parts(tmp_path, parts):
+    prefix = str(tmp_path / "12")
+    for partno, data in parts.items():
+        with open("%s.%s.emlxpart" % (prefix, partno), "wb") as f:
+            f.write(data)
+    return prefix
+
+
+def email_reassemble(data, prefix):
+    # The email-based reassembly this module replaced.
+    msg = email.message_from_bytes(data, policy=EmailPolicy(linesep="\r\n", refold_source="none"))
+
+    def load_parts(message, prefix):
+        for partno, part in enumerate(message.get_payload(), 1):
+            if part.is_multipart():
+                load_parts(part, "%s.%d" % (prefix, partno))
+            elif part[APPLE_MARKER]:
+                with open("%s.%d.emlxpart" % (prefix, partno), "rb") as f:
+                    part.set_payload(f.read())
+                del part[APPLE_MARKER]
+
+    load_parts(msg, prefix)
+    return msg.as_bytes()
+
+
+def leaves(data):
+    # The headers and body of every leaf part, with line endings evened out.
+    result = []
+    for part in email.message_from_bytes(data.replace(b"\r\n", b"\n")).walk():
+        if part.is_multipart():
+            continue
+        payload = part.get_payload(decode=False)
+        if isinstance(payload, bytes):
+            payload = payload.decode("ascii", "surrogateescape")
+        headers = [(name.lower(), " ".join(value.split())) for name, value in part.items()]
+        result.append((headers, payload.replace("\r\n", "\n").rstrip("\n")))
+    return result
+
+
+NESTED = (
+    b"From: sender@example.com\n"
+    b"Subject: nested\n"
+    b"MIME-Version: 1.0\n"
+    b"Content-Type: multipart/mixed; boundary=\"outer\"\n"
+    b"\n"
+    b"--outer\n"
+    b"Content-Type: multipart/alternative; boundary=\"inner\"\n"
+    b"\n"
+    b"--inner\n"
+    b"Content-Type: text/plain\n"
+    b"\n"
+    b"Plain text.\n"
+    b"--inner\n"
+    b"Content-Type: text/html\n"
+    b"X-Apple-Content-Length: 21\n"
+    b"\n"
+    b"\n"
+    b"--inner--\n"
+    b"\n"
+    b"--outer\n"
+    b"Content-Type: application/octet-stream\n"
+    b"Content-Transfer-Encoding: base64\n"
+    b"X-Apple-Content-Length: 12\n"
+    b"\n"
+    b"\n"
+    b"--outer--\n"
+)
+
+NESTED_PARTS = {
+    "1.2": b"<p>HTML text.</p>\n",
+    "2": b"AAECAwQFBgcI\n",
+}
+
+
+def test_nested_multiparts(tmp_path):
+    prefix = write_parts(tmp_path, NESTED_PARTS)
+    data, stats = reassemble(NESTED, prefix)
+
+    assert stats.parts_needed == 2
+    assert stats.parts_loaded == 2
+    assert stats.bytes_spliced == sum(len(part) for part in NESTED_PARTS.values())
+    assert stats.missing == []
+    assert APPLE_MARKER.encode("ascii") not in data
+    # The line ending before a delimiter belongs to the delimiter.
+    assert b"<p>HTML text.</p>\n\n--inner--" in data
+    assert b"AAECAwQFBgcI\n\n--outer--" in data
+    assert leaves(data) == leaves(email_reassemble(NESTED, prefix))
+
+
+def test_untouched_bytes_are_kept(tmp_path):
+    prefix = write_parts(tmp_path, NESTED_PARTS)
+    data, stats = reassemble(NESTED, prefix)
+    # Everything before the first stub comes through byte for byte.
+    head = NESTED[:NESTED.index(b"Content-Type: text/html")]
+    assert data.startswith(head)
+
+
+def test_crlf_line_endings(tmp_path):
+    message = NESTED.replace(b"\n", b"\r\n")
+    parts = dict((partno, part.replace(b"\n", b"\r\n")) for partno, part in NESTED_PARTS.items())
+    prefix = write_parts(tmp_path, parts)
+    data, stats = reassemble(message, prefix)
+
+    assert stats.parts_loaded == 2
+    assert APPLE_MARKER.encode("ascii") not in data
+    assert b"\n" not in data.replace(b"\r\n", b"")
+    assert b"<p>HTML text.</p>\r\n\r\n--inner--" in data
+    assert leaves(data) == leaves(email_reassemble(message, prefix))
+
+
+def test_folded_marker_header(tmp_path):
+    message = NESTED.replace(b"X-Apple-Content-Length: 21\n", b"X-Apple-Content-Length:\n 21\n")
+    prefix = write_parts(tmp_path, NESTED_PARTS)
+    data, stats = reassemble(message, prefix)
+
+    assert stats.parts_loaded == 2
+    assert APPLE_MARKER.encode("ascii") not in data
+    assert b"\n 21\n" not in data
+    assert leaves(data) == leaves(email_reassemble(message, prefix))
+
+
+def test_stub_without_blank_line(tmp_path):
+    # The stub's headers run straight into the next delimiter.
+    message = NESTED.replace(b"X-Apple-Content-Length: 12\n\n\n--outer--", b"X-Apple-Content-Length: 12\n--outer--")
+    prefix = write_parts(tmp_path, NESTED_PARTS)
+    data, stats = reassemble(message, prefix)
+
+    assert stats.parts_loaded == 2
+    assert b"Content-Transfer-Encoding: base64\n\nAAECAwQFBgcI\n\n--outer--" in data
+    assert leaves(data) == leaves(email_reassemble(message, prefix))
+
+
+def test_missing_part_file(tmp_path):
+    prefix = write_parts(tmp_path, {"2": NESTED_PARTS["2"]})
+    data, stats = reassemble(NESTED, prefix)
+
+    assert stats.parts_needed == 2
+    assert stats.parts_loaded == 1
+    assert stats.missing == ["%s.1.2.emlxpart" % prefix]
+    # The stub is left as it was.
+    assert b"X-Apple-Content-Length: 21\n\n\n--inner--" in data
+    assert b"AAECAwQFBgcI\n\n--outer--" in data
+
+
+def test_not_multipart(tmp_path):
+    message = b"From: sender@example.com\nSubject: plain\n\nJust text.\n"
+    data, stats = reassemble(message, str(tmp_path / "12"))
+
+    assert data == message
+    assert stats.parts_needed == 0
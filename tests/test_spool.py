@@ -0,0 +1,98 @@
+import struct
+
+from emlx.spool import SPOOL_NAME, TOC_NAME, scan_offsets, spool_extents, toc_offsets
+
+
+def make_spool(count):
+    messages = []
+    for i in range(count):
+        messages.append(
+            b"From sender@example.com Mon Jan  1 00:00:00 2001\n"
+            b"Subject: message %d\n"
+            b"\n"
+            b"Body of message %d.\n"
+            b">From the quoted line of a body.\n"
+            b"\n" % (i, i)
+        )
+    offsets = []
+    position = 0
+    for message in messages:
+        offsets.append(position)
+        position += len(message)
+    return b"".join(messages), offsets
+
+
+def make_bundle(tmp_path, spool, toc):
+    path = tmp_path / "Export.mbox"
+    path.mkdir()
+    (path / SPOOL_NAME).write_bytes(spool)
+    (path / TOC_NAME).write_bytes(toc)
+    return str(path)
+
+
+def test_toc_with_32_bit_offsets():
+    spool, offsets = make_spool(5)
+    toc = b"".join(struct.pack(">III", 0x1234, offset, 42) for offset in offsets)
+    assert toc_offsets(toc, spool) == offsets
+
+
+def test_toc_in_little_endian():
+    spool, offsets = make_spool(5)
+    toc = struct.pack("<I", len(offsets)) + b"".join(struct.pack("<I", offset) for offset in offsets)
+    assert toc_offsets(toc, spool) == offsets
+
+
+def test_toc_not_understood():
+    # Unaligned 64-bit records: only their zero words look like an offset.
+    spool, offsets = make_spool(5)
+    toc = b"\x01\x00" + b"".join(struct.pack("<Q", offset) for offset in offsets)
+    assert toc_offsets(toc, spool) == []
+
+
+def test_toc_missing_a_message():
+    spool, offsets = make_spool(5)
+    toc = b"".join(struct.pack(">I", offset) for offset in offsets[:-1])
+    assert toc_offsets(toc, spool) == []
+
+
+def test_unquoted_from_lines_in_bodies():
+    # A From line in a body that is not after a blank line is not a message.
+    spool = b"From a\nSubject: one\n\nline\nFrom the body\n\nFrom b\nSubject: two\n\nline\n"
+    second = spool.index(b"From b")
+    assert scan_offsets(spool) == [0, second]
+    assert toc_offsets(struct.pack(">II", 0, second), spool) == [0, second]
+
+
+def test_extents_from_toc(tmp_path):
+    spool, offsets = make_spool(5)
+    toc = b"".join(struct.pack(">I", offset) for offset in offsets)
+    extents = spool_extents(make_bundle(tmp_path, spool, toc))
+    assert [offset for offset, length in extents] == offsets
+    assert sum(length for offset, length in extents) == len(spool)
+
+
+def test_extents_fall_back_to_scanning(tmp_path):
+    spool, offsets = make_spool(5)
+    toc = b"\x01\x00" + b"".join(struct.pack("<Q", offset) for offset in offsets)
+    extents = spool_extents(make_bundle(tmp_path, spool, toc))
+    assert [offset for offset, length in extents] == offsets
+    assert sum(length for offset, length in extents) == len(spool)
+
+
+
+def test_toc_with_irregular_records():
+    # Records holding each message's start and end: the ends point at the
+    # next message too, so the offsets found are not one per record.
+    spool, offsets = make_spool(5)
+    ends = offsets[1:] + [len(spool)]
+    toc = b"".join(struct.pack(">II", offset, end) for offset, end in zip(offsets, ends))
+    assert toc_offsets(toc, spool) == []
+
+
+def test_toc_with_crlf_line_endings():
+    spool, offsets = make_spool(5)
+    spool = spool.replace(b"\n", b"\r\n")
+    # Each message is six lines long.
+    offsets = [offset + 6 * i for i, offset in enumerate(offsets)]
+    toc = b"".join(struct.pack(">I", offset) for offset in offsets)
+    assert toc_offsets(toc, spool) == offsets